@@ -1,5 +1,6 @@
 import sys
 import os
+from datetime import timedelta
 from environ import Env
 from pathlib import Path
 
@@ -177,9 +178,45 @@ TESTING = "test" in sys.argv
 
 CELERY_BROKER_URL = "redis://redis:6379/0"
 CELERY_RESULT_BACKEND = "redis://redis:6379/0"
-CELERY_ACCEPT_CONTENT = ["application/json"]
+CELERY_ACCEPT_CONTENT = ["application/json", "application/x-core-msgpack"]
 CELERY_RESULT_SERIALIZER = "json"
-CELERY_TASK_SERIALIZER = "json"
+# "core-msgpack" is compact binary format registered by app_core.wire
+CELERY_TASK_SERIALIZER = env("CELERY_TASK_SERIALIZER", default="json")
 CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+CELERY_BEAT_SCHEDULE = {
+    "sweep-expired-tokens": {
+        "task": "app_account.ExpiredTokenSweeperTask",
+        "schedule": timedelta(minutes=10),
+    },
+}
+# Enable priorities of Redis broker, see app_core.routing
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "queue_order_strategy": "priority",
+    "priority_steps": list(range(10)),
+    "sep": ":",
+}
+
+# Shared cache is used for cross-worker coordination, e.g. in-flight background task registry
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": env("CACHE_URL", default="redis://redis:6379/1"),
+    }
+}
+if TESTING:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+
+# Timing metrics of executor tasks, e.g. "app_core.instrumentation.StatsdSink"
+CORE_TASK_METRICS_SINK = env("CORE_TASK_METRICS_SINK", default="")
+CORE_TASK_METRICS_SINK_OPTIONS = {}
 
 TOKEN_EXPIRED_AFTER_SECONDS = int(env("TOKEN_EXPIRED_AFTER_SECONDS", default=60 * 60))
+# Authenticated tokens and API keys are cached in process and in shared cache
+TOKEN_CACHE_TIMEOUT = int(env("TOKEN_CACHE_TIMEOUT", default=5 * 60))
+TOKEN_LOCAL_CACHE_TIMEOUT = int(env("TOKEN_LOCAL_CACHE_TIMEOUT", default=5))
+# Zero disables cache of verified API keys
+API_KEY_CACHE_TIMEOUT = int(env("API_KEY_CACHE_TIMEOUT", default=5 * 60))
+# Team memberships of user are cached between requests, zero disables cache
+MEMBERSHIP_CACHE_TIMEOUT = int(env("MEMBERSHIP_CACHE_TIMEOUT", default=60))
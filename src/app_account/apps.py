@@ -1,6 +1,56 @@
 from django.apps import AppConfig
+from django.db.models import signals
 
 
 class AppAccountConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app_account"
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from rest_framework.authtoken.models import Token
+
+        from . import handlers, models, tasks  # noqa: F401 tasks are registered on import
+
+        User = get_user_model()
+
+        signals.post_save.connect(
+            handlers.invalidate_token_cache,
+            sender=Token,
+            dispatch_uid="app_account.handlers.invalidate_token_cache_on_save",
+        )
+        signals.post_delete.connect(
+            handlers.invalidate_token_cache,
+            sender=Token,
+            dispatch_uid="app_account.handlers.invalidate_token_cache_on_delete",
+        )
+        signals.post_save.connect(
+            handlers.invalidate_user_cache,
+            sender=User,
+            dispatch_uid="app_account.handlers.invalidate_user_cache_on_save",
+        )
+        signals.post_delete.connect(
+            handlers.invalidate_user_cache,
+            sender=User,
+            dispatch_uid="app_account.handlers.invalidate_user_cache_on_delete",
+        )
+        signals.post_save.connect(
+            handlers.invalidate_api_key_cache,
+            sender=models.AccountAPIKey,
+            dispatch_uid="app_account.handlers.invalidate_api_key_cache_on_save",
+        )
+        signals.post_delete.connect(
+            handlers.invalidate_api_key_cache,
+            sender=models.AccountAPIKey,
+            dispatch_uid="app_account.handlers.invalidate_api_key_cache_on_delete",
+        )
+        signals.post_save.connect(
+            handlers.invalidate_membership_cache,
+            sender=models.Membership,
+            dispatch_uid="app_account.handlers.invalidate_membership_cache_on_save",
+        )
+        signals.post_delete.connect(
+            handlers.invalidate_membership_cache,
+            sender=models.Membership,
+            dispatch_uid="app_account.handlers.invalidate_membership_cache_on_delete",
+        )
@@ -1,43 +1,223 @@
+import hashlib
+import hmac
+
+from django.core.cache import cache
 from django.utils import timezone
 from django.conf import settings
 from rest_framework import authentication, exceptions
+from rest_framework.authtoken.models import Token
 from rest_framework_api_key import permissions as api_key_permissions
 
+from app_core import utils as core_utils
+
 from . import models as account_models
 
+TOKEN_CACHE_KEY = "app_account:token:%s"
+USER_CACHE_KEY = "app_account:user:%s"
+API_KEY_CACHE_KEY = "app_account:api_key:%s"
+API_KEY_DIGEST_CACHE_KEY = "app_account:api_key_digest:%s"
+
+# First tier of token and API key cache, entries live at most TOKEN_LOCAL_CACHE_TIMEOUT
+local_cache = core_utils.LocalCache()
+
 
 class ExpiringTokenAuthentication(authentication.TokenAuthentication):
     """Same as in DRF, but also handle Token expiration.
 
-    An expired Token will be removed and a new Token with a different
-    key is created that the User can obtain by logging in with his
-    credentials.
+    An expired Token is rejected and a new Token with a different
+    key is issued when the User logs in with his credentials.
+
+    Authenticated tokens are cached, so a warm token is checked without queries.
 
     Raise AuthenticationFailed as needed, which translates
     to a 401 status code automatically.
     """
 
     def authenticate_credentials(self, key):
+        cached = get_cached_token(key)
+        if cached is not None:
+            return cached
+
         user_, token = super().authenticate_credentials(key)
         if is_token_expired(token):
             raise exceptions.AuthenticationFailed("Token has expired")
+        cache_token(token)
         return user_, token
 
 
 def is_token_expired(token):
-    if (timezone.now() - token.created).seconds >= settings.TOKEN_EXPIRED_AFTER_SECONDS:
-        token.delete()
-        return True
-    return False
+    """ Expired tokens are not deleted here, they are removed by ExpiredTokenSweeperTask """
+    age = (timezone.now() - token.created).total_seconds()
+    return age >= settings.TOKEN_EXPIRED_AFTER_SECONDS
+
+
+def rotate_token(token):
+    """ Replace key of expired token in place and return actual token of the user """
+    key = Token.generate_key()
+    updated = Token.objects.filter(key=token.key).update(key=key, created=timezone.now())
+    invalidate_token_cache(token.key)
+    if not updated:
+        # Token has been rotated by concurrent request or removed by sweeper
+        return Token.objects.get_or_create(user=token.user)[0]
+    return Token.objects.get(key=key)
+
+
+def get_token_expiry(token):
+    return token.created + timezone.timedelta(seconds=settings.TOKEN_EXPIRED_AFTER_SECONDS)
+
+
+def get_token_cache_key(key):
+    # Raw token is never used as cache key
+    return TOKEN_CACHE_KEY % hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def get_user_cache_key(user_id):
+    return USER_CACHE_KEY % user_id
+
+
+def get_from_cache(cache_key):
+    value = local_cache.get(cache_key)
+    if value is None:
+        value = cache.get(cache_key)
+        if value is not None:
+            local_cache.set(cache_key, value, settings.TOKEN_LOCAL_CACHE_TIMEOUT)
+    return value
+
+
+def set_to_cache(cache_key, value, timeout):
+    cache.set(cache_key, value, timeout)
+    local_cache.set(cache_key, value, min(timeout, settings.TOKEN_LOCAL_CACHE_TIMEOUT))
+
+
+def delete_from_cache(cache_key):
+    local_cache.delete(cache_key)
+    cache.delete(cache_key)
+
+
+def cache_token(token):
+    """ Cache authenticated token and its user until token expires """
+    expires_at = get_token_expiry(token)
+    timeout = min(
+        settings.TOKEN_CACHE_TIMEOUT, int((expires_at - timezone.now()).total_seconds())
+    )
+    if timeout <= 0:
+        return
+    entry = {
+        "user_id": token.user_id,
+        "created": token.created,
+        "expires_at": expires_at,
+    }
+    set_to_cache(get_token_cache_key(token.key), entry, timeout)
+    set_to_cache(get_user_cache_key(token.user_id), token.user, settings.TOKEN_CACHE_TIMEOUT)
+
+
+def get_cached_token(key):
+    """ Return (user, token) of cached valid token or None if it should be checked in DB.
+
+        Raise AuthenticationFailed if cached token has expired.
+    """
+    cache_key = get_token_cache_key(key)
+    entry = get_from_cache(cache_key)
+    if entry is None:
+        return None
+    if entry["expires_at"] <= timezone.now():
+        delete_from_cache(cache_key)
+        raise exceptions.AuthenticationFailed("Token has expired")
+    user = get_from_cache(get_user_cache_key(entry["user_id"]))
+    if user is None or not user.is_active:
+        return None
+    return user, Token(key=key, user=user, created=entry["created"])
+
+
+def invalidate_token_cache(key):
+    delete_from_cache(get_token_cache_key(key))
+
+
+def invalidate_user_cache(user_id):
+    delete_from_cache(get_user_cache_key(user_id))
+
+
+def get_api_key_cache_key(key):
+    # Keyed HMAC is cheap comparing to API key hasher and does not reveal key
+    digest = hmac.new(
+        settings.SECRET_KEY.encode("utf-8"), key.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+    return API_KEY_CACHE_KEY % digest
+
+
+def get_api_key_digest_cache_key(api_key_id):
+    return API_KEY_DIGEST_CACHE_KEY % api_key_id
+
+
+def cache_api_key(key, api_key):
+    """ Cache verified usable API key and its user until key expires """
+    timeout = settings.API_KEY_CACHE_TIMEOUT
+    if api_key.expiry_date is not None:
+        timeout = min(timeout, int((api_key.expiry_date - timezone.now()).total_seconds()))
+    if timeout <= 0 or api_key.revoked:
+        return
+    cache_key = get_api_key_cache_key(key)
+    entry = {
+        "id": api_key.pk,
+        "user_id": api_key.user_id,
+        "expiry_date": api_key.expiry_date,
+    }
+    set_to_cache(cache_key, entry, timeout)
+    # Signal handlers know only ID of API key, so they find cache key by it
+    cache.set(get_api_key_digest_cache_key(api_key.pk), cache_key, timeout)
+    if api_key.user is not None:
+        set_to_cache(
+            get_user_cache_key(api_key.user_id), api_key.user, settings.TOKEN_CACHE_TIMEOUT
+        )
+
+
+def get_cached_api_key_user(key):
+    """ Return (found, user) of cached valid API key """
+    cache_key = get_api_key_cache_key(key)
+    entry = get_from_cache(cache_key)
+    if entry is None:
+        return False, None
+    if entry["expiry_date"] is not None and entry["expiry_date"] <= timezone.now():
+        delete_from_cache(cache_key)
+        return False, None
+    if entry["user_id"] is None:
+        return True, None
+    user = get_from_cache(get_user_cache_key(entry["user_id"]))
+    if user is None:
+        return False, None
+    return True, user
+
+
+def invalidate_api_key_cache(api_key_id):
+    digest_cache_key = get_api_key_digest_cache_key(api_key_id)
+    cache_key = cache.get(digest_cache_key)
+    if cache_key is not None:
+        delete_from_cache(cache_key)
+        cache.delete(digest_cache_key)
 
 
 class ApiKeyAuthentication(authentication.BaseAuthentication):
+    """Authenticate by API key of AccountAPIKey.
+
+    Verification of key is expensive, so verified keys are cached
+    by HMAC of presented key until they are saved or deleted.
+    """
+
     def authenticate(self, request):
         key = api_key_permissions.KeyParser().get(request)
         if key is None:
             return None
 
-        key = request.META["HTTP_AUTHORIZATION"].split()[1]
-        api_key = account_models.AccountAPIKey.objects.get_from_key(key)
+        found, user_ = get_cached_api_key_user(key)
+        if found:
+            return user_, None
+
+        try:
+            api_key = account_models.AccountAPIKey.objects.get_from_key(key)
+        except account_models.AccountAPIKey.DoesNotExist:
+            raise exceptions.AuthenticationFailed("Invalid API key")
+        if api_key.has_expired:
+            raise exceptions.AuthenticationFailed("API key has expired")
+        cache_api_key(key, api_key)
 
         return api_key.user, None
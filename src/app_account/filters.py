@@ -2,12 +2,13 @@ import uuid
 
 from django.db.models import Q
 from django_filters import rest_framework as rest_framework_filters, filters
-from . import models as account_models
+from . import models as account_models, memberships as account_memberships
 
 
 class TeamFilterBackend(rest_framework_filters.DjangoFilterBackend):
     def filter_queryset(self, request, queryset, view):
-        queryset = queryset.filter(memberships__user=request.user)
+        team_ids = account_memberships.get_resolver(request).team_ids
+        queryset = queryset.filter(id__in=team_ids)
         return super().filter_queryset(request, queryset, view)
 
 
@@ -22,9 +23,10 @@ class TeamFilterSet(rest_framework_filters.FilterSet):
 class InvitationFilterBackend(rest_framework_filters.DjangoFilterBackend):
     def filter_queryset(self, request, queryset, view):
         if not request.user.is_superuser:
+            team_ids = account_memberships.get_resolver(request).team_ids
             queryset = queryset.filter(
-                Q(team__memberships__user=request.user) | Q(email=request.user.email)
-            ).distinct()
+                Q(team_id__in=team_ids) | Q(email=request.user.email)
+            )
         queryset = super().filter_queryset(request, queryset, view)
         return queryset
 
@@ -47,7 +49,8 @@ class JoinRequestFilterBackend(rest_framework_filters.DjangoFilterBackend):
 
 class ApiKeyTeamAccessFilterBackend(rest_framework_filters.DjangoFilterBackend):
     def filter_queryset(self, request, queryset, view):
-        queryset = queryset.filter(team__memberships__user=request.user)
+        team_ids = account_memberships.get_resolver(request).team_ids
+        queryset = queryset.filter(team_id__in=team_ids)
         return super().filter_queryset(request, queryset, view)
 
 
@@ -0,0 +1,20 @@
+from . import (
+    authentication as account_authentication,
+    memberships as account_memberships,
+)
+
+
+def invalidate_token_cache(sender, instance, **kwargs):
+    account_authentication.invalidate_token_cache(instance.key)
+
+
+def invalidate_user_cache(sender, instance, **kwargs):
+    account_authentication.invalidate_user_cache(instance.pk)
+
+
+def invalidate_api_key_cache(sender, instance, **kwargs):
+    account_authentication.invalidate_api_key_cache(instance.pk)
+
+
+def invalidate_membership_cache(sender, instance, **kwargs):
+    account_memberships.invalidate_cache(instance.user_id)
@@ -0,0 +1,147 @@
+""" Team memberships of request user, shared by permissions and filter backends.
+
+Team ids and roles of user are loaded once per request. They are also cached
+between requests for MEMBERSHIP_CACHE_TIMEOUT seconds, cache is invalidated
+when transaction that changes memberships of user is committed.
+
+Module also implements bulk changes of team members.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+
+from . import models as account_models
+
+MEMBERSHIP_CACHE_KEY = "app_account:memberships:%s"
+
+
+def get_cache_key(user_id):
+    return MEMBERSHIP_CACHE_KEY % user_id
+
+
+def load_roles(user_id):
+    """ Return mapping of team id to role of user """
+    timeout = settings.MEMBERSHIP_CACHE_TIMEOUT
+    cache_key = get_cache_key(user_id)
+    if timeout:
+        roles = cache.get(cache_key)
+        if roles is not None:
+            return roles
+    roles = dict(
+        account_models.Membership.objects.filter(user_id=user_id).values_list(
+            "team_id", "role"
+        )
+    )
+    if timeout:
+        cache.set(cache_key, roles, timeout)
+    return roles
+
+
+def invalidate_cache(*user_ids):
+    """ Drop cached roles of users after commit.
+
+        Otherwise concurrent request could cache roles read before commit.
+    """
+    cache_keys = [get_cache_key(user_id) for user_id in user_ids]
+    if cache_keys:
+        transaction.on_commit(lambda: cache.delete_many(cache_keys))
+
+
+class MembershipResolver:
+    def __init__(self, user):
+        self.user = user
+        self._roles = None
+
+    @property
+    def roles(self):
+        if self._roles is None:
+            if self.user is None or self.user.pk is None:
+                self._roles = {}
+            else:
+                self._roles = load_roles(self.user.pk)
+        return self._roles
+
+    @property
+    def team_ids(self):
+        return self.roles.keys()
+
+    def is_member(self, team_id, roles=None):
+        role = self.roles.get(team_id)
+        return role is not None and (roles is None or role in roles)
+
+    def get_role(self, team_id):
+        return self.roles.get(team_id)
+
+
+def get_resolver(request):
+    """ Return membership resolver of request user, it is created once per request """
+    resolver = getattr(request, "_membership_resolver", None)
+    if resolver is None or resolver.user != request.user:
+        resolver = MembershipResolver(request.user)
+        request._membership_resolver = resolver
+    return resolver
+
+
+class Outcome:
+    ADDED = "added"
+    ALREADY_MEMBER = "already_member"
+    NOT_FOUND = "not_found"
+    REMOVED = "removed"
+    NOT_MEMBER = "not_member"
+
+
+def add_users(
+    team, user_ids, role=account_models.Membership.Role.GENERAL, batch_size=1000
+):
+    """ Add users to team with bulk inserts. Return list of (user id, outcome).
+
+        Existing memberships are left as is. Signals are not sent for new memberships,
+        so membership cache of added users is invalidated explicitly.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    found_ids = set(
+        get_user_model().objects.filter(pk__in=user_ids).values_list("pk", flat=True)
+    )
+    member_ids = set(
+        team.memberships.filter(user_id__in=user_ids).values_list("user_id", flat=True)
+    )
+    new_ids = [
+        user_id
+        for user_id in user_ids
+        if user_id in found_ids and user_id not in member_ids
+    ]
+    # Conflicts are possible only if users are added concurrently
+    account_models.Membership.objects.bulk_create(
+        [
+            account_models.Membership(team=team, user_id=user_id, role=role)
+            for user_id in new_ids
+        ],
+        batch_size=batch_size,
+        ignore_conflicts=True,
+    )
+    invalidate_cache(*new_ids)
+
+    def get_outcome(user_id):
+        if user_id not in found_ids:
+            return Outcome.NOT_FOUND
+        if user_id in member_ids:
+            return Outcome.ALREADY_MEMBER
+        return Outcome.ADDED
+
+    return [(user_id, get_outcome(user_id)) for user_id in user_ids]
+
+
+def remove_users(team, user_ids):
+    """ Remove users from team with bulk delete. Return list of (user id, outcome).
+
+        Delete signals are sent, so membership cache is invalidated by handlers.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    memberships = account_models.Membership.objects.filter(team=team, user_id__in=user_ids)
+    removed_ids = set(memberships.values_list("user_id", flat=True))
+    memberships.delete()
+    return [
+        (user_id, Outcome.REMOVED if user_id in removed_ids else Outcome.NOT_MEMBER)
+        for user_id in user_ids
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 01:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app_account', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='teams',
+            field=models.ManyToManyField(blank=True, related_name='users', through='app_account.Membership', to='app_account.Team'),
+        ),
+    ]
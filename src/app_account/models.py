@@ -12,11 +12,9 @@ from app_core import mixins as core_mixins
 
 
 class User(AbstractUser):
-    @property
-    def teams(self):
-        return Team.objects.filter(
-            id__in=self.memberships.all().values_list("team", flat=True)
-        )
+    teams = models.ManyToManyField(
+        "Team", through="Membership", related_name="users", blank=True
+    )
 
 
 class Team(core_mixins.UuidMixin, TimeStampedModel, models.Model):
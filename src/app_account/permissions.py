@@ -1,18 +1,18 @@
-from django.db.models import Q
 from rest_framework import permissions
 from rest_framework import exceptions, request
 from rest_framework_api_key.permissions import HasAPIKey
 
-from . import models as account_models
+from . import models as account_models, memberships as account_memberships
 
 
 class TeamModelAccessPermissions(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.user.is_superuser:
             return True
-        return account_models.Membership.objects.filter(
-            user=request.user, team=obj.owner
-        ).exists()
+        team = obj.owner
+        return team is not None and account_memberships.get_resolver(request).is_member(
+            team.pk
+        )
 
 
 class RequestHasAPIKey(HasAPIKey):
@@ -26,9 +26,9 @@ class InvitationPermissions(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.user.is_superuser:
             return True
-        return account_models.Invitation.objects.filter(
-            Q(team__memberships__user=request.user) | Q(email=request.user.email)
-        ).exists()
+        if obj.email == request.user.email:
+            return True
+        return account_memberships.get_resolver(request).is_member(obj.team_id)
 
 
 class JoinRequestPermissions(permissions.BasePermission):
@@ -1,8 +1,11 @@
 from rest_framework import serializers, exceptions, validators
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Prefetch
 from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
-from rest_framework.reverse import reverse
+
+from app_core import utils as core_utils
 
 from . import (
     models as account_models,
@@ -15,14 +18,16 @@ class UserSerializer(serializers.ModelSerializer):
     teams = serializers.SerializerMethodField()
 
     def get_teams(self, instance):
-        return [
-            reverse(
-                "team-detail",
-                kwargs={"uuid": t.uuid},
-                request=self.context.get("request", None),
+        url_template = self.get_team_url_template()
+        return [core_utils.build_url(url_template, t.uuid) for t in instance.teams.all()]
+
+    def get_team_url_template(self):
+        # Serializer of list is shared by all users, so template is built once
+        if not hasattr(self, "_team_url_template"):
+            self._team_url_template = core_utils.get_url_template(
+                "team-detail", "uuid", self.context.get("request", None)
             )
-            for t in instance.teams.all()
-        ]
+        return self._team_url_template
 
     class Meta:
         model = User
@@ -117,6 +122,16 @@ class TeamSerializer(serializers.ModelSerializer):
     #     required=False  # for update
     # )
 
+    # Team of membership is set by prefetch, so only users are joined
+    prefetch_plan = {
+        "memberships": (
+            Prefetch(
+                "memberships",
+                queryset=account_models.Membership.objects.select_related("user"),
+            ),
+        ),
+    }
+
     class Meta:
         model = account_models.Team
         fields = (
@@ -139,6 +154,16 @@ class TeamUserAddSerializer(serializers.Serializer):
     )
 
 
+class TeamUsersBulkSerializer(serializers.Serializer):
+    users = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False
+    )
+    role = serializers.ChoiceField(
+        choices=account_models.Membership.Role.CHOICES,
+        default=account_models.Membership.Role.GENERAL,
+    )
+
+
 class InvitationSerializer(serializers.ModelSerializer):
     url = serializers.HyperlinkedIdentityField(
         view_name="invitation-detail", lookup_field="uuid"
@@ -202,31 +227,31 @@ class AccountAPIKeySerializer(serializers.HyperlinkedModelSerializer):
         )
 
     def validate(self, attrs):
-        if attrs["name"] in account_models.User.objects.all().values_list(
-            "username", flat=True
-        ):
+        if account_models.User.objects.filter(username=attrs["name"]).exists():
             raise exceptions.ValidationError("name must be unique for username")
 
         # if not attrs['user'].is_configuration_member(attrs['team']):
         #     raise exceptions.ValidationError('user must be configuration')
         return attrs
 
+    @transaction.atomic
     def create(self, validated_data):
-        user_ = account_models.User.objects.create_user(
+        # API key user is never authenticated by password, so it is not hashed
+        user_ = account_models.User(
             username=validated_data["name"],
-            password="test",
             email=f'{validated_data["name"]}@test.test',
         )
+        user_.set_unusable_password()
+        user_.save(force_insert=True)
         account_models.Membership.objects.create(
             user=user_,
             team=validated_data["team"],
             role=account_models.Membership.Role.CONFIGURATION,
         )
-        api_key_obj, key = account_models.AccountAPIKey.objects.create_key(
-            name=validated_data["name"]
+        # Key is assigned before insert, so API key is saved only once
+        api_key_obj = account_models.AccountAPIKey(
+            name=validated_data["name"], user=user_, team=validated_data["team"]
         )
-        api_key_obj.user = user_
-        api_key_obj.team = validated_data["team"]
-        api_key_obj.key = key
-        api_key_obj.save()
+        api_key_obj.key = account_models.AccountAPIKey.objects.assign_key(api_key_obj)
+        api_key_obj.save(force_insert=True)
         return api_key_obj
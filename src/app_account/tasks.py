@@ -0,0 +1,40 @@
+import logging
+
+from celery import current_app
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from app_core import tasks as core_tasks
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiredTokenSweeperTask(core_tasks.BackgroundTask):
+    """ Delete expired authentication tokens in batches.
+
+        Authentication only rejects expired tokens, so they are removed here
+        periodically instead of on request path.
+    """
+    name = 'app_account.ExpiredTokenSweeperTask'
+    batch_size = 1000
+
+    def run(self):
+        expired_before = timezone.now() - timezone.timedelta(
+            seconds=settings.TOKEN_EXPIRED_AFTER_SECONDS
+        )
+        expired_tokens = Token.objects.filter(created__lte=expired_before)
+        deleted = 0
+        while True:
+            keys = list(expired_tokens.values_list('key', flat=True)[:self.batch_size])
+            if not keys:
+                break
+            # Token may be rotated on login while batch is deleted
+            count, _ = expired_tokens.filter(key__in=keys).delete()
+            deleted += count
+        if deleted:
+            logger.info('%s expired tokens have been deleted.', deleted)
+        return deleted
+
+
+current_app.tasks.register(ExpiredTokenSweeperTask())
@@ -6,15 +6,21 @@ from unittest import skip
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework.reverse import reverse
-from rest_framework.test import APITestCase
+from rest_framework.test import APIRequestFactory, APITestCase
 from rest_framework import status, exceptions
 from rest_framework.authtoken.models import Token
 
 
+from app_core.tests.utils import ConstantQueriesMixin
+
 from . import (
     models as account_models,
-    authentication as account_authentication
+    authentication as account_authentication,
+    memberships as account_memberships,
+    permissions as account_permissions,
+    tasks as account_tasks,
 )
 
 User = get_user_model()
@@ -82,7 +88,7 @@ class CoreTests(APITestCase):
         return f"Api-Key {self.api_key_obj.key}"
 
 
-class TeamTests(CoreTests):
+class TeamTests(ConstantQueriesMixin, CoreTests):
     def setUp(self):
         super().setUp()
         # To test search teams with different names
@@ -123,6 +129,120 @@ class TeamTests(CoreTests):
         print(response.json())
         self.assertEqual(response.json()["count"], 1)
 
+    def test_team_list_queries_do_not_depend_on_team_size(self):
+        header = self.get_token_header(self.user_1)
+
+        def get_lists():
+            for url in (reverse("team-list"), reverse("team-all_teams")):
+                response = self.client.get(url, HTTP_AUTHORIZATION=header)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        def add_members():
+            team = account_models.Team.objects.create(name=f"team_{User.objects.count()}")
+            for current_team in (self.team_1, self.team_3, team):
+                user = User.objects.create_user(
+                    f"member_{User.objects.count()}", password="test"
+                )
+                account_models.Membership.objects.create(user=user, team=current_team)
+
+        self.assertConstantQueries(get_lists, add_members)
+
+    def test_users_bulk_add_and_remove(self):
+        cache.clear()
+        header = self.get_token_header(self.user_1)
+        url = reverse("team-users_bulk_add", kwargs={"uuid": self.team_1.uuid})
+        # Membership cache is invalidated on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                url,
+                data=[self.user_2.pk, self.user_1.pk, 999999, self.user_2.pk],
+                format="json",
+                HTTP_AUTHORIZATION=header,
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {"user": self.user_2.pk, "status": "added"},
+                {"user": self.user_1.pk, "status": "already_member"},
+                {"user": 999999, "status": "not_found"},
+            ],
+        )
+        self.assertTrue(
+            account_memberships.MembershipResolver(self.user_2).is_member(self.team_1.pk)
+        )
+
+        url = reverse("team-users_bulk_remove", kwargs={"uuid": self.team_1.uuid})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                url,
+                data={"users": [self.user_2.pk, self.user_2.pk + 1000]},
+                format="json",
+                HTTP_AUTHORIZATION=header,
+            )
+        self.assertEqual(
+            response.json()["results"],
+            [
+                {"user": self.user_2.pk, "status": "removed"},
+                {"user": self.user_2.pk + 1000, "status": "not_member"},
+            ],
+        )
+        self.assertFalse(
+            account_models.Membership.objects.filter(
+                team=self.team_1, user=self.user_2
+            ).exists()
+        )
+        self.assertFalse(
+            account_memberships.MembershipResolver(self.user_2).is_member(self.team_1.pk)
+        )
+
+    def test_only_team_admin_can_bulk_add_privileged_members(self):
+        cache.clear()
+        account_models.Membership.objects.create(
+            user=self.user_2,
+            team=self.team_1,
+            role=account_models.Membership.Role.GENERAL,
+        )
+        user_3 = User.objects.create_user("user_3", password="test")
+        url = reverse("team-users_bulk_add", kwargs={"uuid": self.team_1.uuid})
+        data = {"users": [user_3.pk], "role": account_models.Membership.Role.ADMIN}
+
+        response = self.client.post(
+            url,
+            data=data,
+            format="json",
+            HTTP_AUTHORIZATION=self.get_token_header(self.user_2),
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(
+            account_models.Membership.objects.filter(team=self.team_1, user=user_3).exists()
+        )
+
+        response = self.client.post(
+            url,
+            data=[user_3.pk],
+            format="json",
+            HTTP_AUTHORIZATION=self.get_token_header(self.user_2),
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            account_models.Membership.objects.get(team=self.team_1, user=user_3).role,
+            account_models.Membership.Role.GENERAL,
+        )
+
+        user_4 = User.objects.create_user("user_4", password="test")
+        response = self.client.post(
+            url,
+            data=dict(data, users=[user_4.pk]),
+            format="json",
+            HTTP_AUTHORIZATION=self.get_token_header(self.user_1),
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            account_models.Membership.objects.get(team=self.team_1, user=user_4).role,
+            account_models.Membership.Role.ADMIN,
+        )
+
     def test_team_get_by_api_key(self):
         response = self.client.get(
             reverse("team-list"),
@@ -332,7 +452,7 @@ class JoinRequestTests(CoreTests):
         self.assertEqual(response.json()["count"], 2)
 
 
-class UserTests(CoreTests):
+class UserTests(ConstantQueriesMixin, CoreTests):
     def setUp(self):
         super().setUp()
         self.token_str = self.get_token(self.user_1)
@@ -406,6 +526,25 @@ class UserTests(CoreTests):
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_user_list_queries_do_not_depend_on_page_size(self):
+        def get_list():
+            response = self.client.get(reverse("user-list"))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return response.json()
+
+        def add_users():
+            for index in range(3):
+                user = User.objects.create_user(
+                    f"user_list_{User.objects.count()}", password="test"
+                )
+                account_models.Membership.objects.create(user=user, team=self.team_1)
+
+        self.assertConstantQueries(get_list, add_users)
+
+        team_url = reverse("team-detail", kwargs={"uuid": self.team_1.uuid})
+        users = {item["id"]: item for item in get_list()["results"]}
+        self.assertEqual(users[self.user_1.id]["teams"], ["http://testserver" + team_url])
+
     def test_expired_login_return_new_token(self):
         self.assertNotEqual(self.get_token(self.user_1), self.token_str)
 
@@ -419,6 +558,129 @@ class UserTests(CoreTests):
         )
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
         self.assertEqual(response.json()["detail"], "Token has expired")
+        # Expired token is removed by sweeper, not by authentication
+        self.assertTrue(Token.objects.filter(key=self.token_str).exists())
+
+    def test_token_older_than_day_is_expired(self):
+        self.token_obj.created = timezone.now() - timezone.timedelta(
+            days=1, seconds=settings.TOKEN_EXPIRED_AFTER_SECONDS // 2
+        )
+        self.assertTrue(account_authentication.is_token_expired(self.token_obj))
+
+    def test_expired_tokens_are_swept(self):
+        valid_token = Token.objects.create(user=self.user_2)
+        task = account_tasks.ExpiredTokenSweeperTask()
+        task.batch_size = 1
+        self.assertEqual(task.run(), 1)
+        self.assertFalse(Token.objects.filter(key=self.token_str).exists())
+        self.assertTrue(Token.objects.filter(key=valid_token.key).exists())
+
+
+class TokenCacheTests(CoreTests):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        account_authentication.local_cache.clear()
+        self.authentication = account_authentication.ExpiringTokenAuthentication()
+        self.token_str = self.get_token(self.user_1)
+
+    def test_warm_token_is_authenticated_without_queries(self):
+        self.authentication.authenticate_credentials(self.token_str)
+        with self.assertNumQueries(0):
+            user, token = self.authentication.authenticate_credentials(self.token_str)
+        self.assertEqual(user, self.user_1)
+        self.assertEqual(token.key, self.token_str)
+
+    def test_deleted_token_is_rejected(self):
+        self.authentication.authenticate_credentials(self.token_str)
+        Token.objects.filter(key=self.token_str).delete()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authentication.authenticate_credentials(self.token_str)
+
+    def test_user_change_is_applied(self):
+        self.authentication.authenticate_credentials(self.token_str)
+        self.user_1.is_active = False
+        self.user_1.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authentication.authenticate_credentials(self.token_str)
+
+
+class MembershipResolverTests(CoreTests):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_memberships_are_loaded_once(self):
+        with self.assertNumQueries(1):
+            resolver = account_memberships.MembershipResolver(self.user_1)
+            self.assertTrue(resolver.is_member(self.team_1.pk))
+            self.assertEqual(resolver.get_role(self.team_1.pk), "ADMIN")
+        with self.assertNumQueries(0):
+            resolver = account_memberships.MembershipResolver(self.user_1)
+            self.assertEqual(list(resolver.team_ids), [self.team_1.pk])
+
+    def test_cache_is_invalidated_on_membership_change(self):
+        team_2 = account_models.Team.objects.create(name="AwesomeCustomer2")
+        self.assertFalse(
+            account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            membership = account_models.Membership.objects.create(user=self.user_1, team=team_2)
+        self.assertTrue(
+            account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            membership.delete()
+        self.assertFalse(
+            account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+        )
+
+    def test_cache_is_invalidated_after_commit(self):
+        team_2 = account_models.Team.objects.create(name="AwesomeCustomer2")
+        account_memberships.MembershipResolver(self.user_1).roles
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            account_models.Membership.objects.create(user=self.user_1, team=team_2)
+            # Roles cached before commit are still served
+            self.assertFalse(
+                account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+            )
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(
+            account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+        )
+
+    def test_cache_is_invalidated_by_bulk_changes(self):
+        team_2 = account_models.Team.objects.create(name="AwesomeCustomer2")
+        self.assertFalse(
+            account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+        )
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            account_memberships.add_users(team_2, [self.user_1.pk])
+        self.assertEqual(len(callbacks), 1)
+        self.assertTrue(
+            account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+        )
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            account_memberships.remove_users(team_2, [self.user_1.pk])
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(
+            account_memberships.MembershipResolver(self.user_1).is_member(team_2.pk)
+        )
+
+    def test_invitation_permission_is_checked_per_object(self):
+        team_2 = account_models.Team.objects.create(name="AwesomeCustomer2")
+        foreign_invitation = account_models.Invitation.objects.create(
+            team=team_2, email="test2@test.test"
+        )
+        own_invitation = account_models.Invitation.objects.create(
+            team=self.team_1, email="test2@test.test"
+        )
+        request = APIRequestFactory().get("/")
+        request.user = self.user_1
+        permission = account_permissions.InvitationPermissions()
+        with self.assertNumQueries(1):
+            self.assertFalse(permission.has_object_permission(request, None, foreign_invitation))
+            self.assertTrue(permission.has_object_permission(request, None, own_invitation))
 
 
 class AccountAPIKeyTests(CoreTests):
@@ -462,6 +724,29 @@ class AccountAPIKeyTests(CoreTests):
         )
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_created_apikey_is_valid(self):
+        header = self.get_token_header(self.user_1)
+        team_url = reverse("team-detail", kwargs={"uuid": self.team_1.uuid})
+        response = self.client.post(
+            reverse("apikey-list"),
+            data={"name": "user_2", "team": team_url},
+            HTTP_AUTHORIZATION=header,
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            reverse("apikey-list"),
+            data={"name": "api_key_user", "team": team_url},
+            HTTP_AUTHORIZATION=header,
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(User.objects.get(username="api_key_user").has_usable_password())
+        response = self.client.get(
+            reverse("team-list"),
+            HTTP_AUTHORIZATION=f"Api-Key {response.json()['key']}",
+        )
+        self.assertEqual(response.json()["count"], 1)
+
     def test_apikey_create_delete(self):
         response = self.client.post(
             reverse("apikey-list"),
@@ -498,3 +783,41 @@ class AccountAPIKeyTests(CoreTests):
             HTTP_AUTHORIZATION=self.get_token_header(self.user_1),
         )
         self.assertEqual(response.json()["count"], 2)
+
+
+class ApiKeyCacheTests(CoreTests):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        account_authentication.local_cache.clear()
+        self.authentication = account_authentication.ApiKeyAuthentication()
+
+    def authenticate(self):
+        request = APIRequestFactory().get("/", HTTP_AUTHORIZATION=self.get_api_key_header())
+        return self.authentication.authenticate(request)
+
+    def test_verified_key_is_authenticated_without_queries(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate()
+        self.assertEqual(user, self.user_config_team_1)
+
+    def test_revoked_key_is_rejected(self):
+        self.authenticate()
+        self.api_key_obj.revoked = True
+        self.api_key_obj.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_expired_key_is_rejected(self):
+        self.api_key_obj.expiry_date = timezone.now() - timezone.timedelta(seconds=1)
+        self.api_key_obj.save()
+        with self.assertRaises(exceptions.AuthenticationFailed):
+            self.authenticate()
+
+    def test_invalid_key_is_rejected(self):
+        response = self.client.get(
+            reverse("team-list"),
+            HTTP_AUTHORIZATION=self.get_api_key_header() + "x",
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
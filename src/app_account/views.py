@@ -3,6 +3,7 @@ import logging
 
 from django.shortcuts import render, get_object_or_404
 from django.contrib.auth import get_user_model
+from django.db.models import Prefetch
 from django_filters import rest_framework as rest_framework_filters, filters
 from rest_framework import (
     serializers,
@@ -24,6 +25,7 @@ from . import (
     permissions as account_permissions,
     filters as account_filters,
     authentication as account_authentication,
+    memberships as account_memberships,
 )
 from app_core import (
     views as core_views,
@@ -34,7 +36,9 @@ logger = logging.getLogger("client")
 
 
 class UserViewSet(viewsets.ModelViewSet):
-    queryset = User.objects.all()
+    queryset = User.objects.prefetch_related(
+        Prefetch("teams", queryset=account_models.Team.objects.only("id", "uuid"))
+    )
     serializer_class = account_serializers.UserSerializer
     lookup_field = "pk"
 
@@ -55,7 +59,7 @@ class AccountObtainAuthToken(views.ObtainAuthToken):
         user = serializer.validated_data["user"]
         token, created = Token.objects.get_or_create(user=user)
         if account_authentication.is_token_expired(token):
-            token, created = Token.objects.get_or_create(user=user)
+            token = account_authentication.rotate_token(token)
         return response.Response(
             {
                 "token": token.key,
@@ -74,7 +78,7 @@ class TeamAccessViewSet(core_views.AuthViewSetMixin, viewsets.ModelViewSet):
     lookup_field = "uuid"
 
 
-class TeamViewSet(viewsets.ModelViewSet):
+class TeamViewSet(core_views.PrefetchPlanMixin, viewsets.ModelViewSet):
     queryset = account_models.Team.objects.all()
     serializer_class = account_serializers.TeamSerializer
     authentication_classes = (
@@ -121,11 +125,11 @@ class TeamViewSet(viewsets.ModelViewSet):
         # can be both TeamUserAddSerializer and TeamSerializer
         serializer = account_serializers.TeamUserAddSerializer(data=request.POST)
         if serializer.is_valid():
-            for user in serializer.validated_data["users"]:
-                membership = account_models.Membership.objects.create(
-                    team=team, user=user, role=account_models.Membership.Role.GENERAL
-                )
-            team.save()
+            account_memberships.add_users(
+                team, [user.pk for user in serializer.validated_data["users"]]
+            )
+            # Memberships may be prefetched by get_object
+            team._prefetched_objects_cache = {}
             return response.Response(
                 self.serializer_class(team, context={"request": request}).data,
                 status=status.HTTP_200_OK,
@@ -140,15 +144,64 @@ class TeamViewSet(viewsets.ModelViewSet):
         instance = self.get_object()
         serializer = account_serializers.TeamUserAddSerializer(data=request.POST)
         if serializer.is_valid():
-            memberships = account_models.Membership.objects.filter(
-                team=instance,
-                user__in=serializer.validated_data["users"],
+            account_memberships.remove_users(
+                instance, [user.pk for user in serializer.validated_data["users"]]
             )
-            for m in memberships:
-                m.delete()
-        instance.save()
         return response.Response({}, status=status.HTTP_200_OK)
 
+    def get_bulk_serializer(self, request):
+        # Body is either JSON array of user IDs or object with "users" and "role"
+        data = request.data
+        if isinstance(data, list):
+            data = {"users": data}
+        serializer = account_serializers.TeamUsersBulkSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    def get_bulk_response(self, outcomes):
+        return response.Response(
+            {
+                "results": [
+                    {"user": user_id, "status": outcome} for user_id, outcome in outcomes
+                ]
+            },
+            status=status.HTTP_200_OK,
+        )
+
+    @decorators.action(detail=True, methods=["post"], url_name="users_bulk_add")
+    def users_bulk_add(self, request, uuid=None):
+        """
+        Add many users to the team by IDs, report outcome for each user
+        """
+        team = self.get_object()
+        serializer = self.get_bulk_serializer(request)
+        role = serializer.validated_data["role"]
+        # Only team admins can grant roles other than GENERAL
+        if role != account_models.Membership.Role.GENERAL and not (
+            account_memberships.get_resolver(request).is_member(
+                team.pk, roles=[account_models.Membership.Role.ADMIN]
+            )
+        ):
+            raise exceptions.PermissionDenied(
+                "Only team admins can add members with role %s." % role
+            )
+        outcomes = account_memberships.add_users(
+            team, serializer.validated_data["users"], role
+        )
+        return self.get_bulk_response(outcomes)
+
+    @decorators.action(detail=True, methods=["post"], url_name="users_bulk_remove")
+    def users_bulk_remove(self, request, uuid=None):
+        """
+        Remove many users from the team by IDs, report outcome for each user
+        """
+        team = self.get_object()
+        serializer = self.get_bulk_serializer(request)
+        outcomes = account_memberships.remove_users(
+            team, serializer.validated_data["users"]
+        )
+        return self.get_bulk_response(outcomes)
+
 
 class InvitationViewSet(TeamAccessViewSet):
     queryset = account_models.Invitation.objects.all()
@@ -0,0 +1,277 @@
+""" Asyncio client of backends, counterpart of integration.ServiceProvider.
+
+It is used by fan-out operations, e.g. to poll hundreds of devices from one worker:
+
+    async def pull_devices(provider, devices):
+        async with provider:
+            return await provider.request_many(
+                [('GET', '/devices/%s/' % device.backend_id) for device in devices],
+                return_exceptions=True,
+            )
+
+    responses = asyncio.run(pull_devices(provider, devices))
+
+Number of requests in flight is limited by "max_concurrency" of provider,
+connections, rate limit and circuit breaker follow CORE_PROVIDER_HTTP settings of host.
+JWT is shared with synchronous providers via cache, so both log in once per token lifetime.
+Django cache is blocking, so it is called in threads and event loop keeps sending requests.
+"""
+import asyncio
+import contextlib
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import status
+
+from . import integration, utils
+from .exceptions import BackendRateLimited
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+DEFAULT_CONCURRENCY = 20
+DEFAULT_TIMEOUT = 30
+# Interval of checking whether another worker has logged in
+LOCK_POLL_INTERVAL = 0.1
+
+
+def run_sync(func, *args, **kwargs):
+    """ Run blocking function in thread, return awaitable of its result """
+    return sync_to_async(func, thread_sensitive=False)(*args, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def cache_lock(key, timeout):
+    """ Same as utils.cache_lock, but cache is called in thread """
+    lock = utils.cache_lock(key, timeout=timeout)
+    locked = await run_sync(lock.__enter__)
+    try:
+        yield locked
+    finally:
+        await run_sync(lock.__exit__, None, None, None)
+
+
+async def gather(aws, limit=DEFAULT_CONCURRENCY, return_exceptions=False):
+    """ Same as asyncio.gather, but at most "limit" awaitables are run at once """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(
+        *(run(aw) for aw in aws), return_exceptions=return_exceptions
+    )
+
+
+class AsyncServiceProvider:
+    """ Provider that sends requests concurrently via one httpx client.
+
+        Client is bound to event loop, so provider should be closed before
+        it is used in another loop, e.g. in next asyncio.run call.
+    """
+
+    AuthMethods = integration.ServiceProvider.AuthMethods
+
+    def __init__(
+            self,
+            host='',
+            auth_url='',
+            auth_type=AuthMethods.PASSWORD,
+            credentials={},
+            options={},
+            max_concurrency=DEFAULT_CONCURRENCY,
+            transport=None,
+    ):
+        if httpx is None:
+            raise ImproperlyConfigured('AsyncServiceProvider requires httpx library.')
+
+        self.host = host
+        self.auth_url = auth_url
+        self.auth_type = auth_type
+        self.credentials = credentials
+        self.options = options
+        self.max_concurrency = max_concurrency
+        self.transport = transport
+
+        self.token = {}
+        self._client = None
+        self._semaphore = None
+        self._login_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
+        self._semaphore = None
+        self._login_lock = None
+
+    def get_client(self):
+        if self._client is None:
+            options = integration.get_http_options(integration.get_host(self.host))
+            auth = None
+            if self.auth_type == self.AuthMethods.PASSWORD:
+                auth = httpx.BasicAuth(
+                    self.credentials.get('username', ''),
+                    self.credentials.get('password', ''),
+                )
+            self._client = httpx.AsyncClient(
+                base_url=self.host,
+                auth=auth,
+                headers={'Content-Type': 'application/json', 'Accept': 'application/json'},
+                limits=httpx.Limits(
+                    max_connections=options['POOL_MAXSIZE'] if options['POOL_BLOCK'] else None,
+                    max_keepalive_connections=options['POOL_MAXSIZE'],
+                ),
+                timeout=DEFAULT_TIMEOUT,
+                transport=self.transport,
+            )
+        return self._client
+
+    def get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def get_token_cache_key(self):
+        return integration.get_token_cache_key(self.host, self.auth_url, self.credentials)
+
+    async def fetch_jwt(self):
+        """ Authenticate in backend and return new token """
+        # As in synchronous provider, certificate of auth server is not verified
+        async with httpx.AsyncClient(
+                verify=False, timeout=integration.AUTH_TIMEOUT, transport=self.transport
+        ) as client:
+            response = await client.post(
+                self.auth_url,
+                json=self.credentials,
+                headers={'Accept': 'application/json'},
+            )
+        if response.status_code != status.HTTP_200_OK:
+            raise Exception("Auth Exception")
+
+        return response.json().get('token', None)
+
+    async def get_jwt(self):
+        """ Return token shared with other workers, see ServiceProvider.get_jwt.
+
+            Event loop is not blocked while another worker is logging in.
+        """
+        cache_key = self.get_token_cache_key()
+        entry = await run_sync(cache.get, cache_key)
+        if entry is not None and not integration.is_token_due(entry):
+            return entry['token']
+
+        is_valid = entry is not None and not integration.is_token_expired(entry)
+        lock_key = cache_key + ':lock'
+        deadline = time.monotonic() + (0 if is_valid else integration.TOKEN_LOCK_WAIT)
+        while True:
+            async with cache_lock(lock_key, timeout=integration.AUTH_TIMEOUT) as locked:
+                if locked:
+                    # Token could be refreshed while lock was awaited
+                    fresh_entry = await run_sync(cache.get, cache_key)
+                    if fresh_entry is not None and not integration.is_token_due(fresh_entry):
+                        return fresh_entry['token']
+                    token = await self.fetch_jwt()
+                    await run_sync(integration.store_token, cache_key, token)
+                    return token
+            if is_valid:
+                return entry['token']
+            if time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            entry = await run_sync(cache.get, cache_key)
+            if entry is not None and not integration.is_token_expired(entry):
+                return entry['token']
+
+        # Worker holding the lock is stuck, do not wait for it anymore
+        token = await self.fetch_jwt()
+        await run_sync(integration.store_token, cache_key, token)
+        return token
+
+    def invalidate_token(self):
+        """ Drop shared token, e.g. if backend has rejected it """
+        cache.delete(self.get_token_cache_key())
+        self.token.pop('token', None)
+
+    async def login_jwt(self):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        # Concurrent requests of provider wait for single login
+        async with self._login_lock:
+            if 'token' not in self.token:
+                self.token.update({'token': await self.get_jwt()})
+
+    async def login(self):
+        if self.auth_type == self.AuthMethods.JWT:
+            await self.login_jwt()
+
+    async def get_auth_headers(self):
+        if self.auth_type == self.AuthMethods.JWT:
+            if 'token' not in self.token:
+                await self.login_jwt()
+            return {'Authorization': 'Bearer {}'.format(self.token.get('token', ''))}
+        if self.auth_type == self.AuthMethods.API_KEY:
+            return {
+                'Authorization': 'Api-Key {API_KEY}'.format(
+                    API_KEY=self.credentials.get('API_KEY')
+                )
+            }
+        return {}
+
+    async def request(self, method, url, **kwargs):
+        """ Send request, url can be relative to host. Returns httpx.Response """
+        async with self.get_semaphore():
+            headers = await self.get_auth_headers()
+            headers.update(kwargs.pop('headers', None) or {})
+            return await self.send(method, url, headers=headers, **kwargs)
+
+    async def send(self, method, url, **kwargs):
+        client = self.get_client()
+        host = integration.get_host(str(client.base_url.join(url)))
+        breaker = integration.get_breaker(host)
+        state = await run_sync(breaker.before_call)
+        try:
+            await integration.get_rate_limiter(host).acquire_async()
+        except BackendRateLimited:
+            await run_sync(breaker.release, state)
+            raise
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError:
+            await run_sync(breaker.after_call, state, failed=True)
+            raise
+        await run_sync(
+            breaker.after_call, state, failed=integration.is_failed_response(response.status_code)
+        )
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def request_many(self, requests, return_exceptions=False):
+        """ Send requests concurrently, return responses in the same order.
+
+            Request is tuple of method, url and optional dict of keyword arguments.
+        """
+        return await asyncio.gather(
+            *(
+                self.request(method, url, **(params[0] if params else {}))
+                for method, url, *params in requests
+            ),
+            return_exceptions=return_exceptions,
+        )
@@ -2,3 +2,22 @@ class ServiceBackend:
     """ Basic  backed with only common methods pre-defined. """
 
     DEFAULTS = {}
+
+    def get_batch_key(self):
+        """ Return key that is equal for backends that can serve instances in one call.
+
+            Poll tasks group pending instances by this key and pull them together.
+            None disables batching.
+        """
+        return None
+
+    def call_many(self, method, instances):
+        """ Run backend method for many instances, return results in the same order.
+
+            Backend can define "<method>_many" to handle all instances with one request.
+        """
+        many_method = getattr(self, method + '_many', None)
+        if many_method is not None:
+            results = many_method(instances)
+            return list(results) if results is not None else [None] * len(instances)
+        return [getattr(self, method)(instance) for instance in instances]
@@ -0,0 +1,149 @@
+""" Local execution engine for synchronous executors.
+
+Task, success link and failure link are run as plain calls in current process,
+without Celery eager machinery. Link semantics are the same as in Celery:
+ - success link receives result of task unless it is immutable;
+ - failure link receives id of failed task, result is available
+   via get_result while link is running.
+
+Tasks of chain are run one by one, result of task is passed to the next one
+unless it is immutable. Other composite signatures, e.g. groups, are applied
+by Celery in eager mode.
+"""
+import logging
+import threading
+import traceback
+from uuid import uuid4
+
+from celery import states
+from celery.canvas import _chain
+from celery.exceptions import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class LocalResult:
+    """ Result of task run by local engine, mimics Celery AsyncResult """
+
+    def __init__(self, id, result=None, traceback=None, state=states.SUCCESS):
+        self.id = id
+        self.result = result
+        self.traceback = traceback
+        self.state = state
+
+    def failed(self):
+        return self.state == states.FAILURE
+
+    def successful(self):
+        return self.state == states.SUCCESS
+
+    def get(self):
+        if self.failed():
+            raise self.result
+        return self.result
+
+
+_results = threading.local()
+
+
+def get_result(task_id):
+    """ Return result of failed task which failure link is running """
+    return getattr(_results, 'values', {}).get(task_id)
+
+
+def apply(signature, args=(), parent_id=None):
+    """ Run task of signature in current process and return LocalResult """
+    task = signature.type
+    task.app  # bind task class to application
+    task_id = signature.options.get('task_id') or str(uuid4())
+    args = tuple(args) + tuple(signature.args)
+    kwargs = dict(signature.kwargs)
+    retries = 0
+    while True:
+        task.push_request(
+            id=task_id, parent_id=parent_id, args=args, kwargs=kwargs, retries=retries
+        )
+        try:
+            return LocalResult(task_id, task.run(*args, **kwargs))
+        except Retry:
+            # As in eager mode retry is executed immediately
+            if task.max_retries is not None and retries >= task.max_retries:
+                return LocalResult(
+                    task_id,
+                    task.MaxRetriesExceededError(
+                        "Can't retry %s[%s] args:%s kwargs:%s"
+                        % (task.name, task_id, args, kwargs)
+                    ),
+                    state=states.FAILURE,
+                )
+            retries += 1
+        except Exception as e:
+            return LocalResult(
+                task_id, e, traceback=traceback.format_exc(), state=states.FAILURE
+            )
+        finally:
+            task.pop_request()
+
+
+def apply_eager(signature, args=()):
+    """ Apply composite signature with Celery and return LocalResult """
+    result = signature.apply(args=args)
+    try:
+        return LocalResult(result.id, result.get())
+    except Exception as e:
+        return LocalResult(
+            result.id, e, traceback=traceback.format_exc(), state=states.FAILURE
+        )
+
+
+def apply_chain(signature, args=(), parent_id=None):
+    """ Run tasks of chain in order, stop on first failure. Return result of last run task """
+    result = None
+    for task in signature.tasks:
+        task_args = () if task.immutable else args
+        result = apply_signature(task, args=task_args, parent_id=parent_id)
+        if result.failed():
+            break
+        args = (result.result,)
+        parent_id = result.id
+    return result
+
+
+def apply_signature(signature, args=(), parent_id=None):
+    if isinstance(signature, _chain):
+        return apply_chain(signature, args=args, parent_id=parent_id)
+    if signature.subtask_type:
+        return apply_eager(signature, args=args)
+    return apply(signature, args=args, parent_id=parent_id)
+
+
+def apply_callback(callback, value, parent_id):
+    args = () if callback.immutable else (value,)
+    result = apply_signature(callback, args=args, parent_id=parent_id)
+    if result.failed():
+        # As in Celery, failure of callback does not change result of task
+        logger.error(
+            'Callback %s of task %s failed: %s\n%s',
+            callback.task,
+            parent_id,
+            result.result,
+            result.traceback,
+        )
+    return result
+
+
+def run(signature, link=None, link_error=None):
+    """ Run task with links and return its result, raise exception if task failed """
+    result = apply_signature(signature)
+    if result.failed():
+        if link_error is not None:
+            if not hasattr(_results, 'values'):
+                _results.values = {}
+            _results.values[result.id] = result
+            try:
+                apply_callback(link_error, result.id, result.id)
+            finally:
+                del _results.values[result.id]
+    elif link is not None:
+        apply_callback(link, result.result, result.id)
+    return result.get()
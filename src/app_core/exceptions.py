@@ -15,3 +15,12 @@ class RuntimeStateException(Exception):
 class ExtensionDisabled(APIException):
     status_code = status.HTTP_424_FAILED_DEPENDENCY
     default_detail = _('Extension is disabled.')
+
+
+class BackendUnavailable(Exception):
+    """ Backend call is rejected without sending request """
+    pass
+
+
+class BackendRateLimited(BackendUnavailable):
+    pass
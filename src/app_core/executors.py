@@ -1,10 +1,58 @@
+import json
 import operator
+from collections import defaultdict
 from functools import reduce
 
-from . import models, tasks, utils, mixins
+from celery import current_app, group
+from django.db import transaction
+
+from . import engines, models, tasks, utils, mixins, routing
+
+
+class SignatureDispatcher:
+    """ Publish Celery signatures after current transaction commit.
+
+    Signatures published together are queued by one on_commit callback and sent
+    using single producer connection when transaction is committed. Callback is
+    dropped if transaction or savepoint it was registered in is rolled back.
+    Outside of atomic block signatures are published immediately.
+    """
+
+    def publish(self, signature, using=None, **options):
+        self.publish_many([signature], using=using, **options)
+
+    def publish_many(self, signatures, using=None, **options):
+        """ Publish signatures with the same options """
+        signatures = list(signatures)
+        transaction.on_commit(lambda: self.flush(signatures, options), using=using)
+
+    def flush(self, signatures, options):
+        if not signatures:
+            return
+        with current_app.producer_or_acquire() as producer:
+            for signature in signatures:
+                signature.apply_async(producer=producer, **options)
+
+
+dispatcher = SignatureDispatcher()
 
 
 class BaseExecutor:
+    """ Base class of executors.
+
+        Executor declares priority class and cost estimate of its operation,
+        they define queue and priority of published tasks, see app_core.routing.
+    """
+
+    priority_class = routing.Priorities.DEFAULT
+    cost = 1
+
+    @classmethod
+    def get_routing_options(cls, is_heavy_task=False, priority_class=None):
+        return routing.get_routing_options(
+            priority_class or cls.priority_class, cls.cost, is_heavy_task
+        )
+
     @classmethod
     def get_task_signature(cls, instance, serialized_instance, **kwargs):
         raise NotImplementedError('Executor %s should implement method `get_task_signature`' % cls.__name__)
@@ -20,8 +68,12 @@ class BaseExecutor:
         return None
 
     @classmethod
-    def execute(cls, instance, is_async=True, countdown=2, is_heavy_task=False, **kwargs):
-        """ Execute high level-operation """
+    def execute(cls, instance, is_async=True, countdown=0, is_heavy_task=False, **kwargs):
+        """ Execute high level-operation.
+
+            In asynchronous mode task is published after current transaction commit,
+            so there is no need to delay it until changes are visible to workers.
+        """
         cls.pre_apply(instance, is_async=is_async, **kwargs)
         serialized_instance = utils.serialize_instance(instance)
 
@@ -29,26 +81,115 @@ class BaseExecutor:
         link = cls.get_success_signature(instance, serialized_instance, **kwargs)
         link_error = cls.get_failure_signature(instance, serialized_instance, **kwargs)
         if is_async:
-            return signature.apply_async(
+            result = signature.freeze()
+            dispatcher.publish(
+                signature,
                 link=link,
                 link_error=link_error,
                 countdown=countdown,
-                queue=is_heavy_task and 'heavy' or None,
+                **cls.get_routing_options(is_heavy_task)
             )
+            return result
         else:
-            result = signature.apply()
-            callback = link if not result.failed() else link_error
-            if callback is not None:
-                if not callback.immutable:
-                    callback.args = (result.id,) + callback.args
-                callback.apply()
-            return result.get()  # wait until task is ready
+            # Run task and its links in current process without Celery
+            return engines.run(signature, link=link, link_error=link_error)
+
+    @classmethod
+    def execute_many(
+        cls, instances, countdown=0, is_heavy_task=False, chunk_size=500, **kwargs
+    ):
+        """ Execute high level-operation for many instances in a single dispatch.
+
+            Instances may be passed as queryset or list. States are changed with bulk
+            updates and signatures are published in groups of "chunk_size" tasks.
+            Each task keeps its own success and failure links.
+            Groups are published after current transaction commit
+            with priority of bulk operations.
+        """
+        instances = list(instances)
+        if not instances:
+            return []
+        # Instances which state was not changed, e.g. were deleted meanwhile, are skipped
+        instances = cls.pre_apply_many(instances, **kwargs)
+        if not instances:
+            return []
+
+        signatures = []
+        for instance in instances:
+            serialized_instance = utils.serialize_instance(instance)
+            signature = cls.get_task_signature(instance, serialized_instance, **kwargs)
+            link = cls.get_success_signature(instance, serialized_instance, **kwargs)
+            link_error = cls.get_failure_signature(
+                instance, serialized_instance, **kwargs
+            )
+            if link is not None:
+                signature.link(link)
+            if link_error is not None:
+                signature.link_error(link_error)
+            signatures.append(signature)
+
+        chunks = [
+            group(signatures[start:start + chunk_size])
+            for start in range(0, len(signatures), chunk_size)
+        ]
+        results = [chunk.freeze() for chunk in chunks]
+        dispatcher.publish_many(
+            chunks,
+            countdown=countdown,
+            **cls.get_routing_options(is_heavy_task, routing.Priorities.BULK)
+        )
+        return results
 
     @classmethod
     def pre_apply(cls, instance, **kwargs):
         """ Perform synchronous actions before signature apply """
         pass
 
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        """ Perform synchronous actions before signatures apply for many instances.
+
+            Return instances which signatures should be applied.
+            Override it together with "pre_apply" to use bulk queries.
+        """
+        for instance in instances:
+            cls.pre_apply(instance, **kwargs)
+        return instances
+
+    @staticmethod
+    def bulk_transition(instances, transition_method, **fields):
+        """ Change state of instances with one conditional UPDATE per model.
+
+            Return instances which were moved by transition to its target state, in original order.
+        """
+        transitioned = set()
+        instances_by_model = defaultdict(list)
+        for instance in instances:
+            instances_by_model[instance.__class__].append(instance)
+        for model, model_instances in instances_by_model.items():
+            queryset = model._default_manager.filter(
+                pk__in=[instance.pk for instance in model_instances]
+            )
+            count = model.transition_queryset(queryset, transition_method, **fields)
+            sources = model.get_transition_sources(transition_method)
+            targets = list(sources)
+            if count == len(model_instances) and len(targets) == 1:
+                states = {instance.pk: targets[0] for instance in model_instances}
+            else:
+                states = dict(queryset.values_list('pk', 'state'))
+            for instance in model_instances:
+                if instance.pk not in states:
+                    # Instance is deleted
+                    continue
+                source, instance.state = instance.state, states[instance.pk]
+                if instance.state in targets and model.is_transition_source(
+                    source, sources[instance.state], instance.state
+                ):
+                    for field, value in fields.items():
+                        setattr(instance, field, value)
+                    transitioned.add(id(instance))
+        return [instance for instance in instances if id(instance) in transitioned]
+
     @classmethod
     def as_signature(cls, instance, **kwargs):
         serialized_instance = utils.serialize_instance(instance)
@@ -119,7 +260,7 @@ class CreateExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
      - mark object as erred on failed creation;
     """
 
-    pass
+    priority_class = routing.Priorities.INTERACTIVE
 
 
 class UpdateExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
@@ -130,11 +271,17 @@ class UpdateExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
      - mark object as erred on failed update;
     """
 
+    priority_class = routing.Priorities.INTERACTIVE
+
     @classmethod
     def pre_apply(cls, instance, **kwargs):
         instance.schedule_updating()
         instance.save(update_fields=['state'])
 
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        return cls.bulk_transition(instances, 'schedule_updating')
+
     @classmethod
     def execute(cls, instance, is_async=True, **kwargs):
         if 'updated_fields' not in kwargs:
@@ -143,6 +290,14 @@ class UpdateExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
             )
         super(UpdateExecutor, cls).execute(instance, is_async=is_async, **kwargs)
 
+    @classmethod
+    def execute_many(cls, instances, **kwargs):
+        if 'updated_fields' not in kwargs:
+            raise ExecutorException(
+                'updated_fields keyword argument should be defined for UpdateExecutor.'
+            )
+        return super(UpdateExecutor, cls).execute_many(instances, **kwargs)
+
 
 class DeleteExecutor(DeleteExecutorMixin, BaseExecutor):
     """ Default states transition for object deletion.
@@ -152,11 +307,17 @@ class DeleteExecutor(DeleteExecutorMixin, BaseExecutor):
      - mark object as erred on failed deletion;
     """
 
+    priority_class = routing.Priorities.INTERACTIVE
+
     @classmethod
     def pre_apply(cls, instance, **kwargs):
         instance.schedule_deleting()
         instance.save(update_fields=['state'])
 
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        return cls.bulk_transition(instances, 'schedule_deleting')
+
 
 class ActionExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
     """ Default states transition for executing action with object.
@@ -168,6 +329,7 @@ class ActionExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
 
     # TODO: After refactoring field action should become mandatory for implementation
     action = ''
+    priority_class = routing.Priorities.INTERACTIVE
 
     @classmethod
     def get_action_details(cls, instance, **kwargs):
@@ -182,3 +344,27 @@ class ActionExecutor(SuccessExecutorMixin, ErrorExecutorMixin, BaseExecutor):
         instance.action = cls.action
         instance.action_details = cls.get_action_details(instance, **kwargs)
         instance.save()
+
+    @classmethod
+    def pre_apply_many(cls, instances, **kwargs):
+        # Instances with equal action details are updated with one query
+        instances_by_details = defaultdict(list)
+        details_by_key = {}
+        applied = set()
+        for instance in instances:
+            if instance.state == mixins.StateMixin.States.UPDATE_SCHEDULED:
+                applied.add(id(instance))
+                continue
+            action_details = cls.get_action_details(instance, **kwargs)
+            key = json.dumps(action_details, sort_keys=True, default=str)
+            details_by_key[key] = action_details
+            instances_by_details[key].append(instance)
+        for key, grouped_instances in instances_by_details.items():
+            transitioned = cls.bulk_transition(
+                grouped_instances,
+                'schedule_updating',
+                action=cls.action,
+                action_details=details_by_key[key],
+            )
+            applied.update(id(instance) for instance in transitioned)
+        return [instance for instance in instances if id(instance) in applied]
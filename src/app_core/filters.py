@@ -1,11 +1,34 @@
+import operator
+from functools import reduce
+
+from django.db.models import Exists, OuterRef, Q
 from django_filters import filters, rest_framework as rest_framework_filters
 
+from . import utils as core_utils
+
 
 class PropertyListCharFilter(filters.CharFilter):
+    """ Filter by comma-separated values of model property named by field_name.
+
+        Filtering is done by database if queryset has annotation with this name
+        or property is declared with app_core.utils.query_property.
+        Other properties are computed in Python for each object of queryset.
+    """
+
     def filter(self, qs, value):
         if value not in filters.EMPTY_VALUES:
             value = [str(item) for item in value.split(",")]
-            filtered_pks = [el.pk for el in qs if el.change_state in value]
+            name = self.field_name
+            if name in qs.query.annotations:
+                return qs.filter(**{"%s__in" % name: value})
+            expression = core_utils.get_property_expression(qs.model, name)
+            if expression is not None:
+                # Alias is not selected, so it does not clash with property
+                alias = "%s_value" % name
+                return qs.alias(**{alias: expression}).filter(**{"%s__in" % alias: value})
+            filtered_pks = [
+                el.pk for el in qs.iterator() if str(getattr(el, name)) in value
+            ]
             return qs.filter(pk__in=filtered_pks)
         return super().filter(qs, value)
 
@@ -25,12 +48,28 @@ class ListNumberFilter(filters.NumberFilter):
 
 
 class UnionFilterBackend(rest_framework_filters.DjangoFilterBackend):
+    """ Return objects that pass at least one of backends in "filter_backends_union" of view.
+
+        Backend may define method "get_filter_condition(request, queryset, view)"
+        that returns Q object or boolean expression. Condition should not join
+        multi-valued relations, wrap them into Exists instead.
+        Other backends are applied to all objects of model and matched by EXISTS
+        subquery. So joins of backends never duplicate rows and DISTINCT is not needed.
+    """
+
+    def get_filter_condition(self, backend, request, queryset, view):
+        if hasattr(backend, "get_filter_condition"):
+            return backend.get_filter_condition(request, queryset, view)
+        filtered = backend.filter_queryset(
+            request, queryset.model._default_manager.all(), view
+        )
+        return Exists(filtered.order_by().filter(pk=OuterRef("pk")))
+
     def filter_queryset(self, request, queryset, view):
-        """
-        TODO: implementing union operator(+, |) for filter_backends could be useful in the future, like permissions
-        Not completed
-        """
-        for backend in view.filter_backends_union:
-            queryset |= backend().filter_queryset(request, queryset, view)
-        queryset = super().filter_queryset(request, queryset.distinct(), view)
-        return queryset
+        conditions = [
+            Q(self.get_filter_condition(backend(), request, queryset, view))
+            for backend in view.filter_backends_union
+        ]
+        if conditions:
+            queryset = queryset.filter(reduce(operator.or_, conditions))
+        return super().filter_queryset(request, queryset, view)
@@ -0,0 +1,110 @@
+""" Timing metrics of tasks that are run by executors.
+
+Task records duration of its stages and time spent in queue after it became due.
+Metrics are exported to sink configured in settings:
+
+    CORE_TASK_METRICS_SINK = 'app_core.instrumentation.StatsdSink'
+    CORE_TASK_METRICS_SINK_OPTIONS = {'host': 'statsd', 'port': 8125}
+
+Metrics are not recorded if sink is not configured.
+"""
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class BaseSink:
+    def record(self, task_name, metric, value):
+        """ Store metric value of task, value is in milliseconds """
+        raise NotImplementedError()
+
+
+class LogSink(BaseSink):
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def record(self, task_name, metric, value):
+        logger.log(self.level, 'Task %s %s: %.2f ms', task_name, metric, value)
+
+
+class StatsdSink(BaseSink):
+    """ Send timings to StatsD-compatible daemon over UDP """
+
+    def __init__(self, host='localhost', port=8125, prefix='celery'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, task_name, metric, value):
+        packet = '%s.%s.%s:%.3f|ms' % (self.prefix, task_name, metric, value)
+        try:
+            self.socket.sendto(packet.encode('utf-8'), self.address)
+        except OSError as e:
+            # Metrics should never break workflow.
+            logger.debug('Cannot send metric to StatsD. Error: %s', e)
+
+
+class MemorySink(BaseSink):
+    """ Aggregate metrics in memory, useful for tests """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(list)
+
+    def record(self, task_name, metric, value):
+        with self.lock:
+            self.values[(task_name, metric)].append(value)
+
+    def get(self, task_name, metric):
+        return list(self.values.get((task_name, metric), []))
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+_sink = None
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        sink_path = getattr(settings, 'CORE_TASK_METRICS_SINK', None)
+        if not sink_path:
+            return None
+        options = getattr(settings, 'CORE_TASK_METRICS_SINK_OPTIONS', {})
+        _sink = import_string(sink_path)(**options)
+    return _sink
+
+
+def set_sink(sink):
+    """ Replace configured sink, None resets it to settings """
+    global _sink
+    _sink = sink
+
+
+def record(task_name, metric, value):
+    sink = get_sink()
+    if sink is not None:
+        sink.record(task_name, metric, value)
+
+
+@contextmanager
+def measure(task_name, metric):
+    """ Record duration of code block in milliseconds """
+    if get_sink() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(task_name, metric, (time.perf_counter() - start) * 1000)
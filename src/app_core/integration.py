@@ -1,6 +1,333 @@
+""" HTTP client of backends.
+
+Sessions of all providers share process-wide connection pools, one pool per host,
+so connections are kept alive and reused by consequent backend calls.
+Pools are configured in settings, limits can be overridden per host:
+
+    CORE_PROVIDER_HTTP = {
+        'POOL_MAXSIZE': 10,
+        'POOL_BLOCK': False,
+        'KEEPALIVE': True,
+        'HOSTS': {
+            'https://inventory.example.com': {'POOL_MAXSIZE': 50, 'POOL_BLOCK': True},
+        },
+    }
+
+POOL_MAXSIZE limits number of kept connections to host. If POOL_BLOCK is set,
+it also limits number of concurrent requests to host in the process.
+
+Calls to host pass rate limiter and circuit breaker shared by workers,
+see resilience module. They are configured by the same options:
+
+    'HOSTS': {
+        'https://inventory.example.com': {
+            'RATE_LIMIT': 20,             # calls per second, None disables limiter
+            'RATE_BURST': 40,
+            'RATE_LIMIT_WAIT': 1,         # max seconds to wait for rate limiter
+            'BREAKER_FAILURES': 5,        # None disables breaker
+            'BREAKER_WINDOW': 60,
+            'BREAKER_RESET_TIMEOUT': 30,
+        },
+    }
+
+Connection errors and 5xx responses are counted as failures. Rejected calls raise
+BackendUnavailable, use get_breaker_states to inspect breakers.
+
+GET responses of host can be cached, see response_cache module:
+
+            'RESPONSE_CACHE_TTL': 5,      # seconds response is fresh, None disables cache
+            'RESPONSE_CACHE_KEEP': 600,   # seconds stale response is kept for revalidation
+            'RESPONSE_CACHE_SIZE': 256,   # max number of responses in process cache
+
+JWT of backend is stored in shared cache by host, auth URL and credentials,
+so workers log in once per token lifetime instead of once per backend call.
+"""
+import base64
+import binascii
+import hashlib
 import json
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
 import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
 from rest_framework import status
+from urllib3.connection import HTTPConnection
+
+from . import resilience, response_cache, utils
+from .exceptions import BackendRateLimited
+
+DEFAULT_HTTP_OPTIONS = {
+    'POOL_MAXSIZE': 10,
+    'POOL_BLOCK': False,
+    'KEEPALIVE': True,
+    'RATE_LIMIT': None,
+    'RATE_BURST': None,
+    'RATE_LIMIT_WAIT': 1,
+    'BREAKER_FAILURES': 5,
+    'BREAKER_WINDOW': 60,
+    'BREAKER_RESET_TIMEOUT': 30,
+    'RESPONSE_CACHE_TTL': None,
+    'RESPONSE_CACHE_KEEP': 600,
+    'RESPONSE_CACHE_SIZE': 256,
+}
+
+
+def get_host(url):
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme.lower(), parts.netloc.lower())
+
+
+def get_http_options(host):
+    options = dict(DEFAULT_HTTP_OPTIONS)
+    configured = getattr(settings, 'CORE_PROVIDER_HTTP', {})
+    options.update({key: value for key, value in configured.items() if key != 'HOSTS'})
+    options.update(configured.get('HOSTS', {}).get(host, {}))
+    return options
+
+
+def get_breaker(host):
+    options = get_http_options(host)
+    return resilience.CircuitBreaker(
+        host,
+        failures=options['BREAKER_FAILURES'],
+        window=options['BREAKER_WINDOW'],
+        reset_timeout=options['BREAKER_RESET_TIMEOUT'],
+    )
+
+
+def get_rate_limiter(host):
+    options = get_http_options(host)
+    return resilience.RateLimiter(
+        host,
+        rate=options['RATE_LIMIT'],
+        burst=options['RATE_BURST'],
+        wait=options['RATE_LIMIT_WAIT'],
+    )
+
+
+def get_response_cache(host):
+    options = get_http_options(host)
+    if not options['RESPONSE_CACHE_TTL']:
+        return None
+    return response_cache.get_cache(
+        host,
+        ttl=options['RESPONSE_CACHE_TTL'],
+        keep=options['RESPONSE_CACHE_KEEP'],
+        size=options['RESPONSE_CACHE_SIZE'],
+    )
+
+
+def is_failed_response(status_code):
+    return status_code >= status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+class PoolingAdapter(HTTPAdapter):
+    """ Adapter of one host, it has pool per TLS settings, e.g. with and without verification """
+
+    def __init__(self, pool_maxsize, pool_block, keepalive):
+        self.keepalive = keepalive
+        super(PoolingAdapter, self).__init__(
+            pool_connections=4, pool_maxsize=pool_maxsize, pool_block=pool_block
+        )
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+        super(PoolingAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class ConnectionPools:
+    """ Process-wide registry of adapters, shared by threads """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.adapters = {}
+
+    def get_adapter(self, host):
+        adapter = self.adapters.get(host)
+        if adapter is None:
+            with self.lock:
+                adapter = self.adapters.get(host)
+                if adapter is None:
+                    options = get_http_options(host)
+                    adapter = PoolingAdapter(
+                        pool_maxsize=options['POOL_MAXSIZE'],
+                        pool_block=options['POOL_BLOCK'],
+                        keepalive=options['KEEPALIVE'],
+                    )
+                    self.adapters[host] = adapter
+        return adapter
+
+    def get_stats(self):
+        """ Return utilisation of connection pools by host """
+        stats = {}
+        with self.lock:
+            adapters = list(self.adapters.items())
+        for host, adapter in adapters:
+            host_stats = {
+                'maxsize': adapter._pool_maxsize,
+                'block': adapter._pool_block,
+                'connections_created': 0,
+                'requests': 0,
+                'idle': 0,
+                'in_use': 0,
+            }
+            connection_pools = adapter.poolmanager.pools
+            for key in connection_pools.keys():
+                pool = connection_pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                # Queue of pool keeps idle connections and None for never used slots
+                queued = list(pool.pool.queue)
+                host_stats['connections_created'] += pool.num_connections
+                host_stats['requests'] += pool.num_requests
+                host_stats['idle'] += sum(1 for conn in queued if conn is not None)
+                host_stats['in_use'] += pool.pool.maxsize - len(queued)
+            stats[host] = host_stats
+        return stats
+
+    def clear(self):
+        with self.lock:
+            adapters = list(self.adapters.values())
+            self.adapters = {}
+        for adapter in adapters:
+            adapter.close()
+
+    def reset(self):
+        """ Forget pools inherited by forked process without closing parent sockets """
+        self.lock = threading.Lock()
+        self.adapters = {}
+
+
+pools = ConnectionPools()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pools.reset)
+
+
+def get_pool_stats():
+    return pools.get_stats()
+
+
+def get_breaker_states(hosts=None):
+    """ Return states of circuit breakers of given hosts, by default of known ones """
+    if hosts is None:
+        hosts = set(getattr(settings, 'CORE_PROVIDER_HTTP', {}).get('HOSTS', {}))
+        hosts.update(pools.adapters)
+    return {host: get_breaker(host).get_state() for host in sorted(hosts)}
+
+
+class ProviderSession(requests.Session):
+    """ Session that sends requests via shared connection pools.
+
+        Session keeps its own headers and cookies, so it should not be shared
+        by threads, but creating it is cheap.
+    """
+
+    def __init__(self):
+        super(ProviderSession, self).__init__()
+        # Adapters of hosts are mounted on first request
+        self.adapters.clear()
+
+    def send(self, request, **kwargs):
+        host = get_host(request.url)
+        if host + '/' not in self.adapters:
+            self.mount(host + '/', pools.get_adapter(host))
+
+        responses = get_response_cache(host)
+        if responses is None or kwargs.get('stream'):
+            return self.send_to_host(host, request, **kwargs)
+        # Cached response is returned before rate limiter and breaker
+        return responses.send(
+            request, lambda prepared: self.send_to_host(host, prepared, **kwargs)
+        )
+
+    def send_to_host(self, host, request, **kwargs):
+        breaker = get_breaker(host)
+        state = breaker.before_call()
+        try:
+            get_rate_limiter(host).acquire()
+        except BackendRateLimited:
+            breaker.release(state)
+            raise
+        try:
+            response = super(ProviderSession, self).send(request, **kwargs)
+        except requests.RequestException:
+            breaker.after_call(state, failed=True)
+            raise
+        breaker.after_call(state, failed=is_failed_response(response.status_code))
+        return response
+
+    def close(self):
+        # Pools are shared with other sessions
+        pass
+
+
+# Token is refreshed by one of workers this number of seconds before expiry
+TOKEN_REFRESH_MARGIN = 60
+# Lifetime of token which expiry is unknown
+TOKEN_DEFAULT_TTL = 5 * 60
+# Max time to wait for login done by another worker
+TOKEN_LOCK_WAIT = 30
+AUTH_TIMEOUT = 60
+
+
+def get_jwt_expiry(token):
+    """ Return "exp" claim of JWT as timestamp, None if token cannot be parsed """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        return float(exp) if exp is not None else None
+    except (AttributeError, IndexError, ValueError, TypeError, binascii.Error):
+        return None
+
+
+def make_token_entry(token):
+    expires_at = get_jwt_expiry(token)
+    refresh_at = None
+    if expires_at is not None:
+        # Short-living tokens are refreshed in the second half of their lifetime
+        lifetime = expires_at - time.time()
+        refresh_at = expires_at - min(TOKEN_REFRESH_MARGIN, lifetime / 2)
+    return {'token': token, 'expires_at': expires_at, 'refresh_at': refresh_at}
+
+
+def get_token_timeout(entry):
+    if entry['expires_at'] is None:
+        return TOKEN_DEFAULT_TTL
+    return max(int(entry['expires_at'] - time.time()), 1)
+
+
+def is_token_expired(entry):
+    return entry['expires_at'] is not None and entry['expires_at'] <= time.time()
+
+
+def is_token_due(entry):
+    """ Return True if token should be refreshed """
+    return entry['refresh_at'] is not None and entry['refresh_at'] <= time.time()
+
+
+def get_token_cache_key(host, auth_url, credentials):
+    return 'app_core:provider_token:%s' % hashlib.sha256(
+        json.dumps(
+            [get_host(host), auth_url, credentials], sort_keys=True, default=str
+        ).encode('utf-8')
+    ).hexdigest()
+
+
+def store_token(cache_key, token):
+    entry = make_token_entry(token)
+    cache.set(cache_key, entry, get_token_timeout(entry))
+    return entry
 
 
 class ServiceProvider:
@@ -31,24 +358,75 @@ class ServiceProvider:
         self.options = options
 
         self.token = {}
+        self._session = None
 
-    def login_jwt(self):
-        session = requests.Session()
-        session.headers.update({
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-        })
+    def get_session(self):
+        if self._session is None:
+            self._session = ProviderSession()
+            self._session.headers.update({
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+            })
+        return self._session
+
+    def get_token_cache_key(self):
+        return get_token_cache_key(self.host, self.auth_url, self.credentials)
+
+    def fetch_jwt(self):
+        """ Authenticate in backend and return new token """
+        session = self.get_session()
         response = session.post(
             self.auth_url,
             data=json.dumps(self.credentials),
-            timeout=60,
+            # Session may already have authorization header of expired token
+            headers={'Authorization': None},
+            timeout=AUTH_TIMEOUT,
             verify=False,
         )
         if response.status_code != status.HTTP_200_OK:
             raise Exception("Auth Exception")
 
-        data = response.json()
-        self.token.update({'token': data.get('token', None)})
+        return response.json().get('token', None)
+
+    def get_jwt(self):
+        """ Return token shared by all workers that use the same backend credentials.
+
+            Token is refreshed TOKEN_REFRESH_MARGIN seconds before expiry by single
+            worker, others keep using current token. If there is no valid token,
+            workers wait until the one that holds lock logs in.
+        """
+        cache_key = self.get_token_cache_key()
+        entry = cache.get(cache_key)
+        if entry is not None and not is_token_due(entry):
+            return entry['token']
+
+        is_valid = entry is not None and not is_token_expired(entry)
+        wait = 0 if is_valid else TOKEN_LOCK_WAIT
+        lock_key = cache_key + ':lock'
+        with utils.cache_lock(lock_key, timeout=AUTH_TIMEOUT, wait=wait) as locked:
+            if not locked:
+                if is_valid:
+                    return entry['token']
+                entry = cache.get(cache_key)
+                if entry is not None and not is_token_expired(entry):
+                    return entry['token']
+                # Worker holding the lock is stuck, do not wait for it anymore
+            else:
+                # Token could be refreshed while lock was awaited
+                fresh_entry = cache.get(cache_key)
+                if fresh_entry is not None and not is_token_due(fresh_entry):
+                    return fresh_entry['token']
+            token = self.fetch_jwt()
+            store_token(cache_key, token)
+            return token
+
+    def invalidate_token(self):
+        """ Drop shared token, e.g. if backend has rejected it """
+        cache.delete(self.get_token_cache_key())
+        self.token.pop('token', None)
+
+    def login_jwt(self):
+        self.token.update({'token': self.get_jwt()})
 
     def login_password(self):
         return NotImplementedError
@@ -60,19 +438,15 @@ class ServiceProvider:
             self.login_password()
 
     def request_header_creator_jwt(self):
-        session = requests.Session()
+        session = self.get_session()
         session.headers.update({
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
             'Authorization': 'Bearer {}'.format(self.token.get('token', ''))
         })
         return session
 
     def request_header_creator_api_key(self):
-        session = requests.Session()
+        session = self.get_session()
         session.headers.update({
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
             # 'Authorization': 'Bearer {}'.format(self.token.get('token', '')),
             'Authorization': 'Api-Key {API_KEY}'.format(API_KEY=self.credentials.get('API_KEY'))
         })
@@ -1,14 +1,17 @@
 import uuid
+from collections import defaultdict
 
 from model_utils import FieldTracker
 from model_utils.models import TimeStampedModel
 from django_fsm import FSMIntegerField, transition
+from django_fsm.signals import post_transition
 from django.apps import apps
 from django.conf import settings
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.db.models import JSONField
+from django.utils import timezone
 from django.utils.encoding import smart_text
 from django.utils.encoding import force_text
 from django.utils.translation import ugettext_lazy as _
@@ -212,6 +215,12 @@ class RuntimeStateMixin(models.Model):
     )
 
 
+class StateQuerySet(models.QuerySet):
+    def transition(self, transition_method, **fields):
+        """ Change state of all objects that are allowed to use transition, return number of them """
+        return self.model.transition_queryset(self, transition_method, **fields)
+
+
 class StateMixin(models.Model):
     class States:
         CREATION_SCHEDULED = 5
@@ -239,6 +248,8 @@ class StateMixin(models.Model):
 
     state = FSMIntegerField(default=States.CREATION_SCHEDULED, choices=States.CHOICES,)
 
+    objects = StateQuerySet.as_manager()
+
     @property
     def human_readable_state(self):
         return force_text(dict(self.States.CHOICES)[self.state])
@@ -276,6 +287,89 @@ class StateMixin(models.Model):
         pass
 
 
+    @classmethod
+    def get_transition_sources(cls, transition_method):
+        """ Return dictionary target state -> source states of transition method """
+        meta = getattr(cls, transition_method)._django_fsm
+        sources = defaultdict(list)
+        for source, fsm_transition in meta.transitions.items():
+            sources[fsm_transition.target].append(source)
+        return sources
+
+    @classmethod
+    def filter_by_sources(cls, queryset, sources, target):
+        if '*' in sources:
+            return queryset
+        if '+' in sources:
+            return queryset.exclude(state=target)
+        return queryset.filter(state__in=sources)
+
+    @classmethod
+    def is_transition_source(cls, state, sources, target):
+        """ Return True if transition to target is allowed from state, see filter_by_sources """
+        if '*' in sources:
+            return True
+        if '+' in sources:
+            return state != target
+        return state in sources
+
+    @classmethod
+    def get_transition_fields(cls, **fields):
+        if any(field.name == 'modified' for field in cls._meta.fields):
+            fields.setdefault('modified', timezone.now())
+        return fields
+
+    @classmethod
+    def transition_queryset(cls, queryset, transition_method, **fields):
+        """ Change state of objects with conditional UPDATE, return number of changed objects.
+
+            Only objects which current state in database is a source of transition
+            are changed. Only state, given fields and modification time are written.
+        """
+        fields = cls.get_transition_fields(**fields)
+        count = 0
+        for target, sources in cls.get_transition_sources(transition_method).items():
+            count += cls.filter_by_sources(queryset, sources, target).update(
+                state=target, **fields
+            )
+        return count
+
+    def transition_state(self, transition_method, **fields):
+        """ Race-safe state transition, return True if it was applied.
+
+            Transition is applied with conditional
+            UPDATE ... WHERE pk = %s AND state = <state of instance> AND state IN (sources),
+            so it is not applied if state was changed concurrently after instance was read,
+            even if transition is allowed from any state. Only state, given fields
+            and modification time are written. Transition method body is not called.
+        """
+        model = self.__class__
+        meta = getattr(model, transition_method)._django_fsm
+        fields = model.get_transition_fields(**fields)
+        queryset = model._default_manager.filter(pk=self.pk, state=self.state)
+        for target, sources in model.get_transition_sources(transition_method).items():
+            conditions_met = all(
+                condition(self)
+                for source in sources
+                for condition in meta.transitions[source].conditions or []
+            )
+            if conditions_met and model.filter_by_sources(queryset, sources, target).update(
+                state=target, **fields
+            ):
+                source = self.state
+                self.state = target
+                for field, value in fields.items():
+                    setattr(self, field, value)
+                post_transition.send(
+                    sender=model,
+                    instance=self,
+                    name=transition_method,
+                    source=source,
+                    target=target,
+                )
+                return True
+        return False
+
     @classmethod
     def get_index_by_str(cls, state_str):
         return list(dict(cls.States.CHOICES).values()).index(str(state_str))
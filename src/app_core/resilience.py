@@ -0,0 +1,158 @@
+""" Rate limiter and circuit breaker of backend hosts, shared by workers via cache.
+
+Rate limiter is token bucket: host accepts "rate" calls per second on average
+and up to "burst" calls at once. Call waits for token at most "wait" seconds.
+
+Circuit breaker is closed while backend works. When "failures" calls fail within
+"window" seconds, it opens and calls are rejected immediately. After "reset_timeout"
+seconds it becomes half-open and lets one probe call through: breaker is closed
+if probe succeeds, otherwise it is opened again.
+"""
+import asyncio
+import logging
+import time
+
+from django.core.cache import cache
+
+from . import utils
+from .exceptions import BackendRateLimited, BackendUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, host, failures=5, window=60, reset_timeout=30):
+        self.host = host
+        # Breaker is disabled if failures is not set
+        self.failures = failures
+        self.window = window
+        self.reset_timeout = reset_timeout
+
+        key = 'app_core:breaker:%s' % host
+        self.state_key = key
+        self.failures_key = key + ':failures'
+        self.probe_key = key + ':probe'
+
+    def get_state(self):
+        """ Return state of breaker for monitoring """
+        state = cache.get(self.state_key) or {'state': self.CLOSED, 'opened_at': None}
+        return {
+            'host': self.host,
+            'state': state['state'],
+            'failures': cache.get(self.failures_key) or 0,
+            'opened_at': state['opened_at'],
+        }
+
+    def before_call(self):
+        """ Return state in which call is made, raise BackendUnavailable if call is rejected """
+        if not self.failures:
+            return self.CLOSED
+        state = cache.get(self.state_key)
+        if state is None:
+            return self.CLOSED
+        if state['state'] == self.OPEN and time.time() - state['opened_at'] < self.reset_timeout:
+            raise BackendUnavailable('Backend %s is unavailable.' % self.host)
+
+        # Probe is released when its result is recorded or after reset timeout
+        if not cache.add(self.probe_key, True, self.reset_timeout):
+            raise BackendUnavailable('Backend %s is unavailable.' % self.host)
+        if state['state'] == self.OPEN:
+            cache.set(self.state_key, dict(state, state=self.HALF_OPEN), None)
+            logger.info('Circuit breaker of %s is half-open.', self.host)
+        return self.HALF_OPEN
+
+    def after_call(self, state, failed):
+        if not self.failures:
+            return
+        if state == self.HALF_OPEN:
+            if failed:
+                self.open()
+            else:
+                self.close()
+        elif failed:
+            cache.add(self.failures_key, 0, self.window)
+            try:
+                failures = cache.incr(self.failures_key)
+            except ValueError:
+                # Window has expired right after it was started
+                cache.set(self.failures_key, 1, self.window)
+                failures = 1
+            if failures >= self.failures:
+                self.open()
+
+    def release(self, state):
+        """ Let another call probe backend, if call was not made """
+        if state == self.HALF_OPEN:
+            cache.delete(self.probe_key)
+
+    def open(self):
+        cache.set(self.state_key, {'state': self.OPEN, 'opened_at': time.time()}, None)
+        cache.delete_many([self.failures_key, self.probe_key])
+        logger.warning('Circuit breaker of %s is open.', self.host)
+
+    def close(self):
+        cache.delete_many([self.state_key, self.failures_key, self.probe_key])
+        logger.info('Circuit breaker of %s is closed.', self.host)
+
+
+class RateLimiter:
+    # Lock protects read-modify-write of bucket, it is held for two cache calls
+    LOCK_INTERVAL = 0.005
+
+    def __init__(self, host, rate=None, burst=None, wait=1):
+        self.host = host
+        # Limiter is disabled if rate is not set
+        self.rate = rate
+        self.burst = burst or rate
+        self.wait = wait
+        self.key = 'app_core:rate_limit:%s' % host
+
+    def reserve(self):
+        """ Take token from bucket. Return 0 if it is taken, otherwise seconds to wait for it """
+        if not self.rate:
+            return 0
+        # Caller sleeps instead of waiting for lock, so async caller awaits sleep
+        # and only cache calls are made in thread, see acquire_async
+        with utils.cache_lock(self.key + ':lock', timeout=1) as locked:
+            if not locked:
+                return self.LOCK_INTERVAL
+            now = time.time()
+            bucket = cache.get(self.key) or {'tokens': self.burst, 'updated': now}
+            tokens = min(self.burst, bucket['tokens'] + (now - bucket['updated']) * self.rate)
+            delay = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                delay = (1 - tokens) / self.rate
+            # Bucket is refilled completely when it is expired
+            cache.set(self.key, {'tokens': tokens, 'updated': now}, int(self.burst / self.rate) + 1)
+            return delay
+
+    def get_delay(self, deadline):
+        """ Return seconds to sleep before next attempt, raise BackendRateLimited if it is too late """
+        delay = self.reserve()
+        if delay and time.monotonic() + delay > deadline:
+            raise BackendRateLimited('Rate limit of backend %s is exceeded.' % self.host)
+        return delay
+
+    def acquire(self):
+        deadline = time.monotonic() + self.wait
+        delay = self.get_delay(deadline)
+        while delay:
+            time.sleep(delay)
+            delay = self.get_delay(deadline)
+
+    async def acquire_async(self):
+        """ Same as acquire, but cache is called in thread, so event loop is not blocked """
+        if not self.rate:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.wait
+        delay = await loop.run_in_executor(None, self.get_delay, deadline)
+        while delay:
+            await asyncio.sleep(delay)
+            delay = await loop.run_in_executor(None, self.get_delay, deadline)
@@ -0,0 +1,138 @@
+""" Cache of backend GET responses, shared by workers.
+
+Poll tasks of different workers fetch the same resources within seconds.
+Successful responses are kept in process LRU cache and in shared Django cache.
+Fresh response is returned without request. Stale one is revalidated with
+conditional request if backend has returned ETag or Last-Modified,
+response 304 is served from cache. Cache is opt-in per host, see integration module.
+"""
+import hashlib
+import threading
+import time
+
+from django.core.cache import cache
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from rest_framework import status
+
+from . import utils
+
+KEY_PREFIX = 'app_core:response:'
+# Responses to different credentials are cached separately
+VARY_HEADERS = ('Authorization', 'Accept')
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+
+def is_cacheable(response):
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    return response.status_code == status.HTTP_200_OK and 'no-store' not in cache_control
+
+
+def is_fresh(entry):
+    return entry['fresh_until'] > time.time()
+
+
+def make_entry(response, ttl):
+    return {
+        'status_code': response.status_code,
+        'reason': response.reason,
+        'headers': dict(response.headers),
+        'content': response.content,
+        'encoding': response.encoding,
+        'url': response.url,
+        'fresh_until': time.time() + ttl,
+    }
+
+
+def get_conditional_headers(entry):
+    headers = CaseInsensitiveDict(entry['headers'])
+    conditional_headers = {}
+    if 'ETag' in headers:
+        conditional_headers['If-None-Match'] = headers['ETag']
+    if 'Last-Modified' in headers:
+        conditional_headers['If-Modified-Since'] = headers['Last-Modified']
+    return conditional_headers
+
+
+def build_response(entry, request):
+    response = Response()
+    response.status_code = entry['status_code']
+    response.reason = entry['reason']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = entry['content']
+    response.encoding = entry['encoding']
+    response.url = entry['url']
+    response.request = request
+    response.from_cache = True
+    return response
+
+
+class ResponseCache:
+    def __init__(self, ttl, keep=600, size=256):
+        # Response is fresh for "ttl" seconds and kept for revalidation for "keep" seconds
+        self.ttl = ttl
+        self.keep = max(keep, ttl)
+        self.local_cache = utils.LocalCache(timeout=ttl, max_size=size)
+
+    def get_cache_key(self, request):
+        parts = [request.url] + [request.headers.get(name) or '' for name in VARY_HEADERS]
+        return KEY_PREFIX + hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        entry = self.local_cache.get(key)
+        if entry is None:
+            entry = cache.get(key)
+            if entry is not None and is_fresh(entry):
+                self.local_cache.set(key, entry, entry['fresh_until'] - time.time())
+        return entry
+
+    def set(self, key, entry):
+        cache.set(key, entry, self.keep)
+        self.local_cache.set(key, entry, self.ttl)
+
+    def delete(self, key):
+        self.local_cache.delete(key)
+        cache.delete(key)
+
+    def send(self, request, send):
+        """ Return response to request from cache, use "send" to make request """
+        if request.method != 'GET':
+            response = send(request)
+            # Resource is likely changed by unsafe request
+            if response.ok:
+                self.delete(self.get_cache_key(request))
+            return response
+        if any(name in request.headers for name in CONDITIONAL_HEADERS):
+            # Caller revalidates its own copy
+            return send(request)
+
+        key = self.get_cache_key(request)
+        entry = self.get(key)
+        if entry is not None:
+            if is_fresh(entry):
+                return build_response(entry, request)
+            request.headers.update(get_conditional_headers(entry))
+
+        response = send(request)
+        if entry is not None and response.status_code == status.HTTP_304_NOT_MODIFIED:
+            entry = dict(entry, fresh_until=time.time() + self.ttl)
+            self.set(key, entry)
+            return build_response(entry, request)
+        if is_cacheable(response):
+            self.set(key, make_entry(response, self.ttl))
+        return response
+
+
+_caches = {}
+_lock = threading.Lock()
+
+
+def get_cache(host, ttl, keep, size):
+    """ Return response cache of host, it is shared by sessions of process """
+    # Options are part of key, so changed settings take effect
+    cache_key = (host, ttl, keep, size)
+    response_cache = _caches.get(cache_key)
+    if response_cache is None:
+        with _lock:
+            response_cache = _caches.setdefault(cache_key, ResponseCache(ttl, keep, size))
+    return response_cache
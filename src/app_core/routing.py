@@ -0,0 +1,84 @@
+""" Routing of executor tasks to queues and broker priorities.
+
+Each executor declares priority class and cost estimate of its operation.
+Route of priority class defines queue and priority of published tasks.
+By default all classes share default queue and are ordered by broker priority,
+operations which cost reaches HEAVY_COST are sent to "heavy" queue.
+Note that for Redis broker lower priority value means higher priority.
+
+Routes can be overridden in settings, e.g. to consume classes by separate workers:
+
+    CORE_EXECUTOR_ROUTES = {
+        'interactive': {'queue': 'interactive', 'priority': 0},
+        'bulk': {'queue': 'bulk', 'priority': 6},
+    }
+
+Weighted consumption is achieved by number of worker processes
+consuming each queue, e.g. "celery worker -Q interactive,celery -c 8"
+and "celery worker -Q bulk,heavy -c 2".
+"""
+from django.conf import settings
+
+
+class Priorities:
+    INTERACTIVE = 'interactive'
+    DEFAULT = 'default'
+    BULK = 'bulk'
+    HEAVY = 'heavy'
+
+    CHOICES = (INTERACTIVE, DEFAULT, BULK, HEAVY)
+
+
+# Queue None means Celery default queue
+DEFAULT_ROUTES = {
+    Priorities.INTERACTIVE: {'queue': None, 'priority': 0},
+    Priorities.DEFAULT: {'queue': None, 'priority': 3},
+    Priorities.BULK: {'queue': None, 'priority': 6},
+    Priorities.HEAVY: {'queue': 'heavy', 'priority': 9},
+}
+
+HEAVY_COST = 10
+
+
+def get_routing_table():
+    """ Return routes of all priority classes with overrides from settings """
+    overrides = getattr(settings, 'CORE_EXECUTOR_ROUTES', {})
+    return {
+        priority_class: dict(route, **overrides.get(priority_class, {}))
+        for priority_class, route in DEFAULT_ROUTES.items()
+    }
+
+
+def get_heavy_cost():
+    return getattr(settings, 'CORE_EXECUTOR_HEAVY_COST', HEAVY_COST)
+
+
+def get_priority_class(priority_class, cost=1, is_heavy_task=False):
+    if is_heavy_task or cost >= get_heavy_cost():
+        return Priorities.HEAVY
+    return priority_class
+
+
+def get_routing_options(priority_class, cost=1, is_heavy_task=False):
+    """ Return options of apply_async for task of given priority class and cost """
+    route = get_routing_table()[get_priority_class(priority_class, cost, is_heavy_task)]
+    return {key: value for key, value in route.items() if value is not None}
+
+
+def get_executors_routes():
+    """ Return routes of all executors, to inspect routing under load """
+    from app_core.executors import BaseExecutor
+
+    def get_subclasses(cls):
+        for subclass in cls.__subclasses__():
+            yield subclass
+            yield from get_subclasses(subclass)
+
+    return {
+        '%s.%s' % (executor.__module__, executor.__name__): {
+            'priority_class': get_priority_class(executor.priority_class, executor.cost),
+            'cost': executor.cost,
+            'options': get_routing_options(executor.priority_class, executor.cost),
+        }
+        for executor in set(get_subclasses(BaseExecutor))
+    }
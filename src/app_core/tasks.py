@@ -1,15 +1,18 @@
+import hashlib
+import json
 import logging
+import time
 from uuid import uuid4
 
 # from celery.task import Task as CeleryTask
-from celery import Task as CeleryTask, current_app
+from celery import Task as CeleryTask, current_app, states
+from celery.utils.time import get_exponential_backoff_interval
 from celery.worker.request import Request
-from django.db import IntegrityError
+from django.core.cache import cache
 from django.db import models as django_models
 from django.db.models import ObjectDoesNotExist
-from django_fsm import TransitionNotAllowed
 
-from app_core import models, utils, mixins
+from app_core import engines, instrumentation, models, utils, mixins, wire  # noqa: F401 wire registers serializer
 from app_core.exceptions import RuntimeStateException
 
 logger = logging.getLogger(__name__)
@@ -27,9 +30,15 @@ class Task(CeleryTask):
     """ Base class for tasks that are run by executors.
 
     Provides standard way for input data deserialization.
+    If previous task of the chain has been run in the same worker,
+    its instance is reused instead of loading it again.
+    Durations of run stages and queue latency are exported to
+    instrumentation sink if it is configured.
     """
     name = 'app_core.Task'
 
+    reuse_chain_instance = True
+
     @classmethod
     def get_description(cls, *args, **kwargs):
         """ Add additional information about task to celery logs.
@@ -38,26 +47,66 @@ class Task(CeleryTask):
         """
         raise NotImplementedError()
 
+    def apply_async(self, args=None, kwargs=None, **options):
+        """ Mark message with time when task should start to measure queue latency """
+        due_at = time.time()
+        if hasattr(options.get('eta'), 'timestamp'):
+            due_at = options['eta'].timestamp()
+        elif options.get('countdown'):
+            due_at += options['countdown']
+        options['headers'] = dict(options.get('headers') or {}, core_due_at=due_at)
+        return super(Task, self).apply_async(args=args, kwargs=kwargs, **options)
+
     def run(self, serialized_instance, *args, **kwargs):
         """ Deserialize input data and start backend operation execution """
+        self.record_queue_latency()
+        with instrumentation.measure(self.name, 'run'):
+            with instrumentation.measure(self.name, 'deserialize'):
+                instance = self.resolve_instance(serialized_instance)
+
+            self.args = args
+            self.kwargs = kwargs
+
+            # State transitions are done before and after execution
+            with instrumentation.measure(self.name, 'pre_execute'):
+                self.pre_execute(instance)
+            # Backend call
+            with instrumentation.measure(self.name, 'execute'):
+                result = self.execute(instance, *self.args, **self.kwargs)
+            with instrumentation.measure(self.name, 'post_execute'):
+                self.post_execute(instance)
+        if self.reuse_chain_instance and self.request.id and instance.pk is not None:
+            utils.chain_instances.put(self.request.id, serialized_instance, instance)
+        if result and isinstance(result, django_models.Model):
+            result = utils.serialize_instance(result)
+        return result
+
+    def record_queue_latency(self):
+        """ Record how long task waited in queue after its countdown or ETA """
+        due_at = getattr(self.request, 'core_due_at', None)
+        if due_at is None:
+            due_at = (self.request.headers or {}).get('core_due_at')
+        if due_at is not None:
+            instrumentation.record(
+                self.name, 'queue_latency', max(time.time() - due_at, 0) * 1000
+            )
+
+    def resolve_instance(self, serialized_instance):
+        instance = None
+        if self.reuse_chain_instance and self.request.parent_id:
+            instance = utils.chain_instances.pop(
+                self.request.parent_id, serialized_instance
+            )
+        if instance is not None:
+            return instance
         try:
-            instance = utils.deserialize_instance(serialized_instance)
+            return utils.deserialize_instance(serialized_instance)
         except ObjectDoesNotExist:
             raise ObjectDoesNotExist(
                 'Cannot restore instance from serialized object %s. Probably it was deleted.'
                 % serialized_instance
             )
 
-        self.args = args
-        self.kwargs = kwargs
-
-        self.pre_execute(instance)
-        result = self.execute(instance, *self.args, **self.kwargs)
-        self.post_execute(instance)
-        if result and isinstance(result, django_models.Model):
-            result = utils.serialize_instance(result)
-        return result
-
     def pre_execute(self, instance):
         pass
 
@@ -102,20 +151,14 @@ class StateTransitionTask(Task):
             instance.pk,
         )
         old_state = instance.human_readable_state
-        try:
-            getattr(instance, transition_method)()
-            if action is not None:
-                instance.action = action
-            if action_details is not None:
-                instance.action_details = action_details
-            instance.save()
-        except IntegrityError:
-            message = (
-                'Could not change state of %s, using method `%s` due to concurrent update'
-                % (instance_description, transition_method)
-            )
-            raise StateChangeError(message)
-        except TransitionNotAllowed:
+        fields = {}
+        if action is not None:
+            fields['action'] = action
+        if action_details is not None:
+            fields['action_details'] = action_details
+        # Conditional update does not overwrite state changed after instance was loaded
+        if not instance.transition_state(transition_method, **fields):
+            instance.refresh_from_db(fields=['state'])
             message = (
                 'Could not change state of %s, using method `%s`. Current instance state: %s.'
                 % (
@@ -125,14 +168,13 @@ class StateTransitionTask(Task):
                 )
             )
             raise StateChangeError(message)
-        else:
-            logger.info(
-                'State of %s changed from %s to %s, with method `%s`',
-                instance_description,
-                old_state,
-                instance.human_readable_state,
-                transition_method,
-            )
+        logger.info(
+            'State of %s changed from %s to %s, with method `%s`',
+            instance_description,
+            old_state,
+            instance.human_readable_state,
+            transition_method,
+        )
 
     def pre_execute(self, instance):
         state_transition = self.kwargs.pop('state_transition', None)
@@ -218,8 +260,9 @@ class BackendMethodTask(RuntimeStateChangeTask, StateTransitionTask):
         try:
             instance = getattr(backend, backend_method)(instance, *args, **kwargs)
         except Exception as e:
+            # State is changed by error link of the task with conditional update,
+            # so it is not changed in memory here
             instance.error_message = str(e)
-            instance.set_erred()
             instance.save(update_fields=['error_message'])
             raise e
         return instance
@@ -266,20 +309,19 @@ class ErrorMessageTask(Task):
         return 'Add error message to instance "%s".' % instance
 
     def run(self, result_id, serialized_instance, *args, **kwargs):
-        self.result = self.AsyncResult(result_id)
+        self.result = engines.get_result(result_id) or self.AsyncResult(result_id)
         return super(ErrorMessageTask, self).run(serialized_instance, *args, **kwargs)
 
     def save_error_message(self, instance):
         if isinstance(instance, mixins.ErrorMessageMixin):
             instance.error_message = self.result.result or ''
             instance.error_traceback = str(self.result.traceback)
-            instance.set_erred()
             instance.save(update_fields=['error_message', 'error_traceback'])
             # log exception if instance is not already ERRED.
             if instance.state != mixins.StateMixin.States.ERRED:
                 message = 'Instance: %s.\n' % utils.serialize_instance(instance)
                 message += 'Error: %s.\n' % self.result.result
-                message += self.result.traceback
+                message += str(self.result.traceback)
                 logger.exception(message)
 
     def execute(self, instance):
@@ -332,47 +374,81 @@ class BackgroundTask(CeleryTask):
            should log themselves explicitly and make sure that they will not
            spam error messages.
 
-        Implement "is_equal" method to define what tasks are equal and should
-        be executed simultaneously.
+        In-flight tasks are tracked in shared cache registry: scheduling acquires
+        a lease keyed by task identity, lease is released when task succeeds or fails.
+        Lease expires after "lease_timeout" seconds if worker dies without releasing it.
+        Retry is published with the same task id, so it keeps lease of the task.
+
+        Override "get_identity" method to define what tasks are equal and should
+        not be executed simultaneously.
     """
     name = 'app_core.BackgroundTask'
 
     is_background = True
+    lease_timeout = 60 * 60
 
-    def is_equal(self, other_task, *args, **kwargs):
-        """ Return True if task do the same operation as other_task.
+    def get_identity(self, *args, **kwargs):
+        """ Return string that is equal for tasks that do the same operation.
 
-            Note! Other task is represented as serialized celery task - dictionary.
+            By default tasks are equal if they have the same name and input parameters.
         """
-        raise NotImplementedError(
-            'BackgroundTask should implement "is_equal" method to avoid queue overload.'
+        payload = json.dumps([args, kwargs], sort_keys=True, default=str)
+        return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+    def get_lease_key(self, *args, **kwargs):
+        return 'app_core:background_task:%s:%s' % (
+            self.name,
+            self.get_identity(*args, **kwargs),
         )
 
+    def acquire_lease(self, task_id, *args, **kwargs):
+        """ Register task as in-flight. Return False if equal task is already registered """
+        key = self.get_lease_key(*args, **kwargs)
+        if cache.add(key, task_id, timeout=self.lease_timeout):
+            return True
+        # Lease is acquired again by retry of the same task
+        if cache.get(key) == task_id:
+            cache.touch(key, self.lease_timeout)
+            return True
+        return False
+
+    def release_lease(self, task_id, *args, **kwargs):
+        """ Remove task from in-flight registry if lease still belongs to it """
+        key = self.get_lease_key(*args, **kwargs)
+        if cache.get(key) == task_id:
+            cache.delete(key)
+
     def is_previous_task_processing(self, *args, **kwargs):
         """ Return True if exist task that is equal to current and is uncompleted """
-        app = self._get_app()
-        inspect = app.control.inspect()
-        active = inspect.active() or {}
-        scheduled = inspect.scheduled() or {}
-        reserved = inspect.reserved() or {}
-        uncompleted = sum(
-            list(active.values()) + list(scheduled.values()) + list(reserved.values()),
-            [],
-        )
-        return any(self.is_equal(task, *args, **kwargs) for task in uncompleted)
+        return cache.get(self.get_lease_key(*args, **kwargs)) is not None
 
     def apply_async(self, args=None, kwargs=None, **options):
         """ Do not run background task if previous task is uncompleted """
-        if self.is_previous_task_processing(*args, **kwargs):
+        args = args or ()
+        kwargs = kwargs or {}
+        task_id = options.pop('task_id', None) or str(uuid4())
+        if not self.acquire_lease(task_id, *args, **kwargs):
             message = (
                 'Background task %s was not scheduled, because its predecessor is not completed yet.'
                 % self.name
             )
             logger.info(message)
             # It is expected by Celery that apply_async return AsyncResult, otherwise celerybeat dies
-            return self.AsyncResult(options.get('task_id') or str(uuid4()))
-        return super(BackgroundTask, self).apply_async(
-            args=args, kwargs=kwargs, **options
+            return self.AsyncResult(task_id)
+        try:
+            return super(BackgroundTask, self).apply_async(
+                args=args, kwargs=kwargs, task_id=task_id, **options
+            )
+        except Exception:
+            self.release_lease(task_id, *args, **kwargs)
+            raise
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        """ Release lease when task is completed either successfully or with error """
+        if status != states.RETRY:
+            self.release_lease(task_id, *(args or ()), **(kwargs or {}))
+        super(BackgroundTask, self).after_return(
+            status, retval, task_id, args, kwargs, einfo
         )
 
 
@@ -405,18 +481,164 @@ def log_celery_task(request):
 Request.__str__ = log_celery_task
 
 
-class PollRuntimeStateTask(Task):
-    max_retries = 1200
-    default_retry_delay = 5
+def get_poll_max_retries(timeout, backoff, backoff_max, jitter):
+    """ Return number of retries after which polling lasts "timeout" seconds on average """
+    retries, elapsed = 0, 0
+    while elapsed < timeout:
+        delay = min(backoff * 2 ** retries, backoff_max)
+        # Full jitter picks delay uniformly between 0 and its limit
+        elapsed += max(delay / 2 if jitter else delay, 1)
+        retries += 1
+    return retries
+
+
+class PollTask(Task):
+    """ Base class for tasks that wait for instance to reach final state.
+
+        Retries are scheduled with exponential backoff and jitter:
+        delay is retry_backoff * 2 ** retries seconds, limited by retry_backoff_max.
+        If "poll_timeout" is defined, max_retries is derived from it and backoff settings.
+        Instance is always loaded from database, because it is changed by other tasks.
+    """
+    name = 'app_core.PollTask'
+
+    reuse_chain_instance = False
+
+    retry_backoff = 5
+    retry_backoff_max = 60
+    retry_jitter = True
+    # Seconds of polling before task fails
+    poll_timeout = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.poll_timeout is not None and 'max_retries' not in cls.__dict__:
+            cls.max_retries = get_poll_max_retries(
+                cls.poll_timeout, cls.retry_backoff, cls.retry_backoff_max, cls.retry_jitter
+            )
+
+    def get_retry_countdown(self):
+        countdown = get_exponential_backoff_interval(
+            factor=self.retry_backoff,
+            retries=self.request.retries or 0,
+            maximum=self.retry_backoff_max,
+            full_jitter=self.retry_jitter,
+        )
+        return max(countdown, 1)
+
+    def retry(self, *args, **kwargs):
+        kwargs.setdefault('countdown', self.get_retry_countdown())
+        return super(PollTask, self).retry(*args, **kwargs)
+
+
+class PollBackendTask(PollTask):
+    """ Poll task that calls backend method for instance.
+
+        Instances which backends have equal batch key are pulled together:
+        each task registers its instance as pending, and the first task that
+        runs after "sweep_interval" seconds calls backend once for all pending instances.
+        Results are stored in cache until tasks of other instances consume them.
+    """
+    name = 'app_core.PollBackendTask'
+
+    sweep_interval = 5
+
+    def get_backend(self, instance):
+        return instance.get_backend()
+
+    def get_cache_key(self, backend_method, batch_key, suffix):
+        digest = hashlib.md5(str(batch_key).encode('utf-8')).hexdigest()
+        return 'app_core:poll:%s:%s:%s' % (backend_method, digest, suffix)
+
+    def call_backend(self, instance, backend_method):
+        """ Return result of backend method or None if instance waits for batch.
+
+            If lock of shared state is not acquired, step is skipped: instance
+            registers itself as pending again on next retry.
+        """
+        backend = self.get_backend(instance)
+        batch_key = backend.get_batch_key()
+        if batch_key is None:
+            return getattr(backend, backend_method)(instance)
+
+        serialized_instance = utils.serialize_instance(instance)
+        results_key = self.get_cache_key(backend_method, batch_key, 'results')
+        with utils.cache_lock(results_key + ':lock', wait=1) as locked:
+            if not locked:
+                return None
+            results = cache.get(results_key) or {}
+            if serialized_instance in results:
+                result = results.pop(serialized_instance)
+                cache.set(results_key, results, timeout=self.retry_backoff_max * 2)
+                return result
+
+        pending_key = self.get_cache_key(backend_method, batch_key, 'pending')
+        with utils.cache_lock(pending_key + ':lock', wait=1) as locked:
+            if not locked:
+                return None
+            pending = cache.get(pending_key) or set()
+            pending.add(serialized_instance)
+            cache.set(pending_key, pending, timeout=self.retry_backoff_max * 2)
+
+        sweep_key = self.get_cache_key(backend_method, batch_key, 'sweep')
+        if not cache.add(sweep_key, self.request.id or '', timeout=self.sweep_interval):
+            return None
+        results = self.sweep(backend, backend_method, batch_key)
+        if results is None:
+            # Let another task sweep pending instances
+            cache.delete(sweep_key)
+            return None
+        result = results.pop(serialized_instance, None)
+
+        with utils.cache_lock(results_key + ':lock', wait=1) as locked:
+            if not locked:
+                logger.warning(
+                    'Results of backend method `%s` for %s instances are dropped, '
+                    'because lock is not acquired.',
+                    backend_method,
+                    len(results),
+                )
+                return result
+            stored_results = cache.get(results_key) or {}
+            stored_results.update(results)
+            cache.set(results_key, stored_results, timeout=self.retry_backoff_max * 2)
+        return result
+
+    def sweep(self, backend, backend_method, batch_key):
+        """ Call backend once for all pending instances, return results by instance.
+
+            Return None if pending instances could not be taken.
+        """
+        pending_key = self.get_cache_key(backend_method, batch_key, 'pending')
+        with utils.cache_lock(pending_key + ':lock', wait=1) as locked:
+            if not locked:
+                return None
+            pending = cache.get(pending_key) or set()
+            cache.delete(pending_key)
+
+        instances = utils.deserialize_instances(list(pending))
+        results = {
+            utils.serialize_instance(instance): result
+            for instance, result in zip(
+                instances, backend.call_many(backend_method, instances)
+            )
+        }
+        logger.debug(
+            'Backend method `%s` was called for %s pending instances.',
+            backend_method,
+            len(instances),
+        )
+        return results
+
+
+class PollRuntimeStateTask(PollBackendTask):
+    poll_timeout = 100 * 60
     name = 'app_core.PollRuntimeStateTask'
 
     @classmethod
     def get_description(cls, instance, backend_pull_method, *args, **kwargs):
         return 'Poll instance "%s" with method "%s"' % (instance, backend_pull_method)
 
-    def get_backend(self, instance):
-        return instance.get_backend()
-
     def execute(
         self,
         instance,
@@ -426,8 +648,7 @@ class PollRuntimeStateTask(Task):
             deleted_state=None,
     ):
 
-        backend = self.get_backend(instance)
-        getattr(backend, backend_pull_method)(instance)
+        self.call_backend(instance, backend_pull_method)
      #   getattr(backend, kwargs['backend_pull_method'])(instance)
         instance.refresh_from_db()
         if instance.runtime_state not in (success_state, erred_state, deleted_state):
@@ -443,9 +664,8 @@ class PollRuntimeStateTask(Task):
         return instance
 
 
-class PollStateTask(Task):
-    max_retries = 1200
-    default_retry_delay = 5
+class PollStateTask(PollTask):
+    poll_timeout = 100 * 60
     name = 'app_core.PollStateTask'
 
     def execute(self, instance, *args, **kwargs):
@@ -456,22 +676,17 @@ class PollStateTask(Task):
             self.retry()
 
 
-class PollBackendCheckTask(Task):
-    max_retries = 600
-    default_retry_delay = 5
+class PollBackendCheckTask(PollBackendTask):
+    poll_timeout = 50 * 60
     name = 'app_core.PollBackendCheckTask'
 
     @classmethod
     def get_description(cls, instance, backend_check_method, *args, **kwargs):
         return 'Check instance "%s" with method "%s"' % (instance, backend_check_method)
 
-    def get_backend(self, instance):
-        return instance.get_backend()
-
     def execute(self, instance, backend_check_method):
         # backend_check_method should return True if object does not exist at backend
-        backend = self.get_backend(instance)
-        if not getattr(backend, backend_check_method)(instance):
+        if not self.call_backend(instance, backend_check_method):
             self.retry()
         return instance
 
@@ -487,6 +702,8 @@ current_app.tasks.register(ErrorMessageTask())
 current_app.tasks.register(ErrorStateTransitionTask())
 current_app.tasks.register(PreApplyExecutorTask())
 current_app.tasks.register(BackgroundTask())
+current_app.tasks.register(PollTask())
+current_app.tasks.register(PollBackendTask())
 current_app.tasks.register(PollRuntimeStateTask())
 current_app.tasks.register(PollStateTask())
 current_app.tasks.register(PollBackendCheckTask())
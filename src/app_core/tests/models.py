@@ -0,0 +1,15 @@
+from django.db import models
+from model_utils.models import TimeStampedModel
+
+from app_core import mixins
+
+
+class StateModel(mixins.StateMixin, mixins.ErrorMessageMixin, TimeStampedModel):
+    """ Test-only model, its table is created by ModelTablesMixin """
+
+    name = models.CharField(max_length=150, blank=True)
+    action = models.CharField(max_length=50, blank=True)
+    action_details = models.JSONField(default=dict)
+
+    class Meta:
+        app_label = 'app_core'
@@ -1,15 +1,39 @@
+import asyncio
+import base64
 import json
 import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import skipUnless
 
+import httpx
+import requests
 import requests_mock
-from django.test import TestCase
+from celery import Task as CeleryTask, current_app, group, states
+from django.test import TestCase, override_settings
+from django_fsm.signals import post_transition
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Length
 from rest_framework.reverse import reverse
-from rest_framework.test import APITestCase, APIClient
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
 from rest_framework_api_key.models import APIKey
 
 from app_account import models
+from app_core import (
+    async_integration,
+    engines, executors, filters, instrumentation, integration, resilience, routing, tasks,
+    utils, wire,
+)
+from app_core.exceptions import BackendRateLimited, BackendUnavailable
+from app_core.backend import ServiceBackend
+from app_core.tests import models as test_models
+from app_core.tests.utils import ModelTablesMixin
 
 User = get_user_model()
 
@@ -87,3 +111,1102 @@ class CoreTests(APITestCase):
         if key is None:
             return 'Api-Key {API_KEY}'.format(API_KEY=self.key)
         return 'Api-Key {API_KEY}'.format(API_KEY=key)
+
+
+class BackgroundTaskRegistryTest(TestCase):
+    class SyncTask(tasks.BackgroundTask):
+        name = 'app_core.tests.SyncTask'
+
+        def get_identity(self, backend_uuid, *args, **kwargs):
+            return backend_uuid
+
+    def setUp(self):
+        cache.clear()
+        self.task = self.SyncTask()
+
+    def test_equal_task_is_not_registered_twice(self):
+        self.assertTrue(self.task.acquire_lease('task-1', 'backend-1'))
+        self.assertFalse(self.task.acquire_lease('task-2', 'backend-1'))
+        self.assertTrue(self.task.acquire_lease('task-3', 'backend-2'))
+        self.assertTrue(self.task.is_previous_task_processing('backend-1'))
+
+    def test_lease_is_released_on_completion(self):
+        self.task.acquire_lease('task-1', 'backend-1')
+        self.task.after_return('FAILURE', None, 'task-1', ('backend-1',), {}, None)
+        self.assertFalse(self.task.is_previous_task_processing('backend-1'))
+
+    def test_lease_is_kept_by_retry(self):
+        self.assertTrue(self.task.acquire_lease('task-1', 'backend-1'))
+        self.task.after_return('RETRY', None, 'task-1', ('backend-1',), {}, None)
+        self.assertTrue(self.task.acquire_lease('task-1', 'backend-1'))
+        self.assertFalse(self.task.acquire_lease('task-2', 'backend-1'))
+
+        self.task.after_return('SUCCESS', None, 'task-1', ('backend-1',), {}, None)
+        self.assertFalse(self.task.is_previous_task_processing('backend-1'))
+
+    def test_foreign_lease_is_not_released(self):
+        self.task.acquire_lease('task-1', 'backend-1')
+        self.task.release_lease('task-2', 'backend-1')
+        self.assertTrue(self.task.is_previous_task_processing('backend-1'))
+
+
+class SignatureDispatcherTest(TestCase):
+    class FakeSignature:
+        def __init__(self):
+            self.calls = []
+
+        def apply_async(self, **options):
+            self.calls.append(options)
+
+    def test_signatures_are_published_on_commit(self):
+        first, second = self.FakeSignature(), self.FakeSignature()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            executors.dispatcher.publish_many([first, second], countdown=0)
+            self.assertEqual(first.calls, [])
+        # Signatures published together are sent by one callback
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(first.calls), 1)
+        self.assertEqual(len(second.calls), 1)
+        self.assertIs(first.calls[0]['producer'], second.calls[0]['producer'])
+
+    def test_signatures_are_dropped_on_rollback(self):
+        signature = self.FakeSignature()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    executors.dispatcher.publish(signature)
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+        self.assertEqual(signature.calls, [])
+
+    def test_signatures_are_kept_after_rolled_back_savepoint(self):
+        inner, outer = self.FakeSignature(), self.FakeSignature()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    executors.dispatcher.publish(inner)
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            executors.dispatcher.publish(outer)
+        self.assertEqual(inner.calls, [])
+        self.assertEqual(len(outer.calls), 1)
+
+    def test_signatures_of_rolled_back_savepoint_are_dropped(self):
+        outer, inner, last = self.FakeSignature(), self.FakeSignature(), self.FakeSignature()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                executors.dispatcher.publish(outer)
+                try:
+                    with transaction.atomic():
+                        executors.dispatcher.publish(inner)
+                        raise RuntimeError()
+                except RuntimeError:
+                    pass
+                with transaction.atomic():
+                    executors.dispatcher.publish(last)
+        self.assertEqual(len(outer.calls), 1)
+        self.assertEqual(inner.calls, [])
+        self.assertEqual(len(last.calls), 1)
+
+    def test_signatures_are_kept_if_another_savepoint_is_rolled_back(self):
+        signature = self.FakeSignature()
+        with self.captureOnCommitCallbacks(execute=True):
+            executors.dispatcher.publish(signature)
+            try:
+                with transaction.atomic():
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+        self.assertEqual(len(signature.calls), 1)
+
+
+class PollBackendTaskTest(TestCase):
+    class Backend(ServiceBackend):
+        calls = []
+
+        def get_batch_key(self):
+            return 'host'
+
+        def check_many(self, instances):
+            self.calls.append(sorted(instance.pk for instance in instances))
+            return [True for _ in instances]
+
+    class CheckTask(tasks.PollBackendTask):
+        name = 'app_core.tests.CheckTask'
+
+        def get_backend(self, instance):
+            return PollBackendTaskTest.Backend()
+
+    def setUp(self):
+        cache.clear()
+        self.Backend.calls = []
+        self.CheckTask.bind(current_app)
+        self.task = self.CheckTask()
+        self.teams = [models.Team.objects.create(name='team-%s' % i) for i in range(3)]
+
+    def test_pending_instances_are_pulled_with_one_backend_call(self):
+        sweep_key = self.task.get_cache_key('check', 'host', 'sweep')
+        cache.add(sweep_key, 'other-task')
+        for team in self.teams:
+            self.assertIsNone(self.task.call_backend(team, 'check'))
+        self.assertEqual(self.Backend.calls, [])
+
+        cache.delete(sweep_key)
+        self.assertTrue(self.task.call_backend(self.teams[0], 'check'))
+        self.assertTrue(self.task.call_backend(self.teams[1], 'check'))
+        self.assertTrue(self.task.call_backend(self.teams[2], 'check'))
+        self.assertEqual(self.Backend.calls, [[team.pk for team in self.teams]])
+
+    def test_backend_is_not_called_if_lock_is_held(self):
+        pending_key = self.task.get_cache_key('check', 'host', 'pending')
+        cache.add(pending_key + ':lock', True)
+        self.assertIsNone(self.task.call_backend(self.teams[0], 'check'))
+        self.assertEqual(self.Backend.calls, [])
+
+        # Instance is registered again on next retry
+        cache.delete(pending_key + ':lock')
+        self.assertTrue(self.task.call_backend(self.teams[0], 'check'))
+        self.assertEqual(self.Backend.calls, [[self.teams[0].pk]])
+
+    def test_results_are_not_read_if_lock_is_held(self):
+        results_key = self.task.get_cache_key('check', 'host', 'results')
+        cache.set(results_key, {utils.serialize_instance(self.teams[0]): True})
+        cache.add(results_key + ':lock', True)
+        self.assertIsNone(self.task.call_backend(self.teams[0], 'check'))
+        self.assertEqual(len(cache.get(results_key)), 1)
+
+    def test_polling_window_is_kept(self):
+        # Average delay of full jitter is half of backoff
+        def get_window(task):
+            return sum(
+                min(task.retry_backoff * 2 ** retries, task.retry_backoff_max) / 2
+                for retries in range(task.max_retries)
+            )
+        self.assertGreaterEqual(get_window(tasks.PollRuntimeStateTask), 100 * 60)
+        self.assertGreaterEqual(get_window(tasks.PollStateTask), 100 * 60)
+        self.assertGreaterEqual(get_window(tasks.PollBackendCheckTask), 50 * 60)
+
+    def test_retry_delay_grows_exponentially(self):
+        self.task.retry_jitter = False
+        self.task.push_request(retries=3)
+        try:
+            self.assertEqual(self.task.get_retry_countdown(), 40)
+        finally:
+            self.task.pop_request()
+
+
+class DeserializeInstancesTest(TestCase):
+    def test_instances_are_loaded_with_one_query(self):
+        teams = [models.Team.objects.create(name='team-%s' % i) for i in range(3)]
+        serialized = [utils.serialize_instance(team) for team in reversed(teams)]
+        teams[1].delete()
+        with self.assertNumQueries(1):
+            instances = utils.deserialize_instances(serialized)
+        self.assertEqual(instances, [teams[2], teams[0]])
+
+    def test_chain_instance_is_taken_once(self):
+        team = models.Team.objects.create(name='team')
+        serialized = utils.serialize_instance(team)
+        utils.chain_instances.put('task-1', serialized, team)
+        self.assertIsNone(utils.chain_instances.pop('task-2', serialized))
+        self.assertIs(utils.chain_instances.pop('task-1', serialized), team)
+        self.assertIsNone(utils.chain_instances.pop('task-1', serialized))
+
+
+class WireFormatTest(TestCase):
+    def test_message_is_restored(self):
+        serialized_instance = 'app_account.team:1'
+        message = (
+            [serialized_instance, 'pull'],
+            {'updated_fields': {'name', 'description'}, 'action_details': {}},
+            {'callbacks': [{'task': 'app_core.StateTransitionTask', 'args': [serialized_instance]}]},
+        )
+        body = wire.dumps(message)
+        self.assertEqual(wire.loads(body), list(message))
+        self.assertEqual(body.count(serialized_instance.encode()), 1)
+
+
+class TaskInstrumentationTest(TestCase):
+    class RenameTask(tasks.Task):
+        name = 'app_core.tests.RenameTask'
+
+        def execute(self, instance, name):
+            instance.name = name
+            instance.save(update_fields=['name'])
+
+    def setUp(self):
+        self.sink = instrumentation.MemorySink()
+        instrumentation.set_sink(self.sink)
+        self.RenameTask.bind(current_app)
+        self.task = self.RenameTask()
+
+    def tearDown(self):
+        instrumentation.set_sink(None)
+
+    def test_run_stages_are_recorded(self):
+        team = models.Team.objects.create(name='team')
+        self.task.push_request(core_due_at=time.time() - 1)
+        try:
+            self.task.run(utils.serialize_instance(team), 'renamed')
+        finally:
+            self.task.pop_request()
+        for metric in ('deserialize', 'pre_execute', 'execute', 'post_execute', 'run'):
+            self.assertEqual(len(self.sink.get(self.task.name, metric)), 1)
+        self.assertGreaterEqual(self.sink.get(self.task.name, 'queue_latency')[0], 1000)
+
+
+class ExecutorRoutingTest(TestCase):
+    def test_heavy_operations_are_routed_to_heavy_queue(self):
+        self.assertEqual(
+            executors.CreateExecutor.get_routing_options(is_heavy_task=True),
+            {'queue': 'heavy', 'priority': 9},
+        )
+        self.assertEqual(executors.CreateExecutor.get_routing_options(), {'priority': 0})
+
+    @override_settings(CORE_EXECUTOR_ROUTES={'interactive': {'queue': 'interactive'}})
+    def test_routes_are_inspectable(self):
+        routes = routing.get_executors_routes()
+        self.assertEqual(
+            routes['app_core.executors.UpdateExecutor']['options'],
+            {'queue': 'interactive', 'priority': 0},
+        )
+        self.assertEqual(
+            routes['app_core.executors.EmptyExecutor']['priority_class'],
+            routing.Priorities.DEFAULT,
+        )
+
+
+class LocalEngineTest(TestCase):
+    class AddTask(CeleryTask):
+        name = 'app_core.tests.AddTask'
+
+        def run(self, x, y):
+            return x + y
+
+    class FailingTask(CeleryTask):
+        name = 'app_core.tests.FailingTask'
+
+        def run(self):
+            raise ValueError('Backend is not available')
+
+    class RecordTask(CeleryTask):
+        name = 'app_core.tests.RecordTask'
+        calls = []
+
+        def run(self, value, *args):
+            result = engines.get_result(value)
+            self.calls.append(result.result if result is not None else value)
+
+    def setUp(self):
+        self.RecordTask.calls = []
+        for task_class in (self.AddTask, self.FailingTask, self.RecordTask):
+            task_class.bind(current_app)
+
+    def test_success_link_receives_result(self):
+        result = engines.run(
+            self.AddTask().si(1, 2),
+            link=self.RecordTask().s(),
+            link_error=self.RecordTask().s(),
+        )
+        self.assertEqual(result, 3)
+        self.assertEqual(self.RecordTask.calls, [3])
+
+    def test_failure_link_receives_result_of_failed_task(self):
+        with self.assertRaises(ValueError):
+            engines.run(
+                self.FailingTask().si(),
+                link=self.RecordTask().s(),
+                link_error=self.RecordTask().s(),
+            )
+        self.assertEqual(len(self.RecordTask.calls), 1)
+        self.assertIsInstance(self.RecordTask.calls[0], ValueError)
+
+    def test_chain_passes_results_to_next_tasks(self):
+        signature = self.AddTask().si(1, 2) | self.AddTask().s(10) | self.AddTask().si(5, 5)
+        self.assertEqual(engines.run(signature, link=self.RecordTask().s()), 10)
+        self.assertEqual(self.RecordTask.calls, [10])
+        self.assertEqual(
+            engines.run(self.AddTask().si(1, 2) | self.AddTask().s(10)), 13
+        )
+
+    def test_chain_stops_on_failure(self):
+        signature = self.FailingTask().si() | self.AddTask().si(1, 2)
+        with self.assertRaises(ValueError):
+            engines.run(signature, link=self.RecordTask().s(), link_error=self.RecordTask().s())
+        self.assertEqual(len(self.RecordTask.calls), 1)
+        self.assertIsInstance(self.RecordTask.calls[0], ValueError)
+
+    def test_group_is_applied_by_celery(self):
+        add_task = current_app.register_task(self.AddTask())
+        signature = group(add_task.si(1, 2), add_task.si(3, 4))
+        self.assertEqual(engines.run(signature), [3, 7])
+
+    def test_chained_executor_is_executed_synchronously(self):
+        add_task = self.AddTask()
+        record_task = self.RecordTask()
+
+        class ChainedExecutor(executors.BaseExecutor):
+            @classmethod
+            def get_task_signature(cls, instance, serialized_instance, **kwargs):
+                return add_task.si(1, 2) | add_task.s(len(instance.name))
+
+            @classmethod
+            def get_success_signature(cls, instance, serialized_instance, **kwargs):
+                return record_task.s()
+
+        team = models.Team.objects.create(name='team')
+        self.assertEqual(ChainedExecutor.execute(team, is_async=False), 7)
+        self.assertEqual(self.RecordTask.calls, [7])
+
+
+class PropertyListCharFilterTest(TestCase):
+    def setUp(self):
+        for name in ('abc', 'abcde', 'abcdefg'):
+            models.Team.objects.create(name=name)
+        models.Team.name_length = utils.query_property(lambda: Length('name'))(
+            lambda team: len(team.name)
+        )
+        models.Team.plain_name_length = property(lambda team: len(team.name))
+
+    def tearDown(self):
+        del models.Team.name_length
+        del models.Team.plain_name_length
+
+    def filter_names(self, field_name, queryset=None):
+        if queryset is None:
+            queryset = models.Team.objects.all()
+        queryset = filters.PropertyListCharFilter(field_name=field_name).filter(
+            queryset, '3,5'
+        )
+        return sorted(queryset.values_list('name', flat=True))
+
+    def test_query_property_is_filtered_in_database(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.filter_names('name_length'), ['abc', 'abcde'])
+
+    def test_annotation_is_filtered_in_database(self):
+        queryset = models.Team.objects.annotate(size=Length('name'))
+        with self.assertNumQueries(1):
+            self.assertEqual(self.filter_names('size', queryset), ['abc', 'abcde'])
+
+    def test_plain_property_is_filtered_in_python(self):
+        self.assertEqual(self.filter_names('plain_name_length'), ['abc', 'abcde'])
+
+
+class UnionFilterBackendTest(TestCase):
+    class MemberTeamsBackend:
+        def filter_queryset(self, request, queryset, view):
+            return queryset.filter(memberships__user=request.user)
+
+    class PublicTeamsBackend:
+        def get_filter_condition(self, request, queryset, view):
+            return Q(name__startswith='public')
+
+    class View:
+        filter_backends_union = ()
+
+    def setUp(self):
+        self.user = User.objects.create(username='union_user')
+        # Objects are created one by one, bulk_create sets primary keys only on PostgreSQL
+        others = [User.objects.create(username='union_member_%s' % index) for index in range(20)]
+        teams = [
+            models.Team.objects.create(
+                name='%s-%s' % ('public' if index % 5 == 0 else 'team', index)
+            )
+            for index in range(200)
+        ]
+        memberships = []
+        for index, team in enumerate(teams):
+            members = others + [self.user] if index % 2 == 0 else others
+            memberships.extend(models.Membership(team=team, user=user) for user in members)
+        models.Membership.objects.bulk_create(memberships)
+        self.expected = {
+            team.name for index, team in enumerate(teams) if index % 2 == 0 or index % 5 == 0
+        }
+        self.request = Request(APIRequestFactory().get('/'))
+        self.request.user = self.user
+        self.view = self.View()
+        self.view.filter_backends_union = (self.MemberTeamsBackend, self.PublicTeamsBackend)
+
+    def test_union_does_not_duplicate_objects_without_distinct(self):
+        queryset = filters.UnionFilterBackend().filter_queryset(
+            self.request, models.Team.objects.all(), self.view
+        )
+        self.assertNotIn('DISTINCT', str(queryset.query))
+        names = list(queryset.values_list('name', flat=True))
+        self.assertEqual(len(names), len(self.expected))
+        self.assertEqual(set(names), self.expected)
+
+    @skipUnless(connection.vendor == 'postgresql', 'Query plan is checked on PostgreSQL')
+    def test_query_plan_uses_semi_join(self):
+        queryset = filters.UnionFilterBackend().filter_queryset(
+            self.request, models.Team.objects.all(), self.view
+        )
+        plan = queryset.explain()
+        self.assertNotIn('Unique', plan)
+        self.assertTrue('SubPlan' in plan or 'Semi Join' in plan, plan)
+
+
+class ServiceProviderSessionTest(TestCase):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_json({'token': 'jwt'})
+
+        def do_GET(self):
+            self.send_json({'authorization': self.headers['Authorization']})
+
+        def send_json(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        cache.clear()
+        integration.pools.clear()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.host = 'http://127.0.0.1:%s' % self.server.server_port
+
+    def tearDown(self):
+        integration.pools.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused_by_providers(self):
+        for _ in range(3):
+            provider = integration.ServiceProvider(
+                host=self.host,
+                auth_url=self.host + '/auth/',
+                auth_type=integration.ServiceProvider.AuthMethods.JWT,
+            )
+            provider.login()
+            response = provider.request_header_creator().get(self.host + '/devices/')
+            self.assertEqual(response.json(), {'authorization': 'Bearer jwt'})
+
+        stats = integration.get_pool_stats()[self.host]
+        # Token is shared by providers, so only first one logs in
+        self.assertEqual(stats['requests'], 4)
+        # Login skips TLS verification, so it uses its own pool, one connection per pool
+        self.assertEqual(stats['connections_created'], 2)
+        self.assertEqual(stats['in_use'], 0)
+
+    @override_settings(CORE_PROVIDER_HTTP={'HOSTS': {'http://limited': {'POOL_MAXSIZE': 2}}})
+    def test_pool_limits_are_configured_per_host(self):
+        self.assertEqual(integration.pools.get_adapter('http://limited')._pool_maxsize, 2)
+        self.assertEqual(integration.pools.get_adapter(self.host)._pool_maxsize, 10)
+
+    def test_requests_can_be_mocked(self):
+        provider = integration.ServiceProvider(
+            auth_type=integration.ServiceProvider.AuthMethods.API_KEY,
+            credentials={'API_KEY': 'key'},
+        )
+        with requests_mock.Mocker() as mocker:
+            mocker.get('https://backend/devices/', json=[])
+            self.assertEqual(
+                provider.request_header_creator().get('https://backend/devices/').json(), []
+            )
+
+
+class ServiceProviderTokenTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def make_provider(self, username='admin'):
+        return integration.ServiceProvider(
+            host='https://backend',
+            auth_url='https://backend/auth/',
+            auth_type=integration.ServiceProvider.AuthMethods.JWT,
+            credentials={'username': username, 'password': 'secret'},
+        )
+
+    def make_jwt(self, expires_in, name='token'):
+        payload = json.dumps({'exp': time.time() + expires_in, 'name': name})
+        encoded = base64.urlsafe_b64encode(payload.encode('utf-8')).decode('utf-8')
+        return 'header.%s.signature' % encoded.rstrip('=')
+
+    def test_token_is_shared_by_providers_with_same_credentials(self):
+        token = self.make_jwt(3600)
+        with requests_mock.Mocker() as mocker:
+            auth = mocker.post('https://backend/auth/', json={'token': token})
+            for _ in range(3):
+                provider = self.make_provider()
+                provider.login()
+                self.assertEqual(provider.token['token'], token)
+            self.assertEqual(auth.call_count, 1)
+
+            self.make_provider('operator').login()
+            self.assertEqual(auth.call_count, 2)
+
+    def test_token_is_refreshed_before_expiry_by_one_worker(self):
+        old_token, new_token = self.make_jwt(3600, 'old'), self.make_jwt(3600, 'new')
+        provider = self.make_provider()
+        cache_key = provider.get_token_cache_key()
+        entry = dict(integration.make_token_entry(old_token), refresh_at=time.time() - 1)
+        cache.set(cache_key, entry)
+        with requests_mock.Mocker() as mocker:
+            auth = mocker.post('https://backend/auth/', json={'token': new_token})
+            # Another worker is refreshing token, current one is still valid
+            cache.add(cache_key + ':lock', 'another-worker')
+            self.assertEqual(provider.get_jwt(), old_token)
+            self.assertEqual(auth.call_count, 0)
+
+            cache.delete(cache_key + ':lock')
+            self.assertEqual(provider.get_jwt(), new_token)
+            self.assertEqual(self.make_provider().get_jwt(), new_token)
+            self.assertEqual(auth.call_count, 1)
+
+    def test_jwt_expiry_is_parsed(self):
+        self.assertAlmostEqual(
+            integration.get_jwt_expiry(self.make_jwt(100)), time.time() + 100, delta=5
+        )
+        self.assertIsNone(integration.get_jwt_expiry('opaque-token'))
+
+
+class AsyncServiceProviderTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.auth_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, request):
+        if request.url.path == '/auth/':
+            self.auth_calls += 1
+            return httpx.Response(200, json={'token': 'jwt'})
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return httpx.Response(200, json={
+            'path': request.url.path,
+            'authorization': request.headers.get('Authorization'),
+        })
+
+    def make_provider(self, auth_type, credentials, max_concurrency=5):
+        return async_integration.AsyncServiceProvider(
+            host='https://backend',
+            auth_url='https://backend/auth/',
+            auth_type=auth_type,
+            credentials=credentials,
+            max_concurrency=max_concurrency,
+            transport=httpx.MockTransport(self.handle),
+        )
+
+    def request_devices(self, provider, count):
+        async def run():
+            async with provider:
+                return await provider.request_many(
+                    [('GET', '/devices/%s/' % index) for index in range(count)]
+                )
+
+        return [response.json() for response in asyncio.run(run())]
+
+    def test_requests_are_sent_concurrently_with_limit(self):
+        provider = self.make_provider(
+            integration.ServiceProvider.AuthMethods.JWT, {'username': 'admin'}
+        )
+        results = self.request_devices(provider, 30)
+
+        self.assertEqual(
+            [result['path'] for result in results],
+            ['/devices/%s/' % index for index in range(30)],
+        )
+        self.assertEqual(self.max_in_flight, 5)
+        self.assertEqual({result['authorization'] for result in results}, {'Bearer jwt'})
+        self.assertEqual(self.auth_calls, 1)
+
+    def test_token_is_shared_with_synchronous_provider(self):
+        provider = integration.ServiceProvider(
+            host='https://backend',
+            auth_url='https://backend/auth/',
+            auth_type=integration.ServiceProvider.AuthMethods.JWT,
+            credentials={'username': 'admin'},
+        )
+        integration.store_token(provider.get_token_cache_key(), 'sync-jwt')
+        async_provider = self.make_provider(
+            integration.ServiceProvider.AuthMethods.JWT, {'username': 'admin'}
+        )
+        results = self.request_devices(async_provider, 3)
+
+        self.assertEqual(self.auth_calls, 0)
+        self.assertEqual(results[0]['authorization'], 'Bearer sync-jwt')
+
+    def test_api_key_and_password_auth(self):
+        provider = self.make_provider(
+            integration.ServiceProvider.AuthMethods.API_KEY, {'API_KEY': 'key'}
+        )
+        self.assertEqual(self.request_devices(provider, 1)[0]['authorization'], 'Api-Key key')
+
+        provider = self.make_provider(
+            integration.ServiceProvider.AuthMethods.PASSWORD,
+            {'username': 'admin', 'password': 'secret'},
+        )
+        self.assertEqual(
+            self.request_devices(provider, 1)[0]['authorization'],
+            'Basic %s' % base64.b64encode(b'admin:secret').decode('utf-8'),
+        )
+
+    def test_gather_limits_concurrency(self):
+        async def call(index):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            return index
+
+        results = asyncio.run(
+            async_integration.gather([call(index) for index in range(10)], limit=3)
+        )
+        self.assertEqual(results, list(range(10)))
+        self.assertEqual(self.max_in_flight, 3)
+
+
+@override_settings(CORE_PROVIDER_HTTP={'HOSTS': {'https://backend': {
+    'BREAKER_FAILURES': 3, 'BREAKER_RESET_TIMEOUT': 30, 'RATE_LIMIT': 1, 'RATE_BURST': 2,
+    'RATE_LIMIT_WAIT': 0,
+}}})
+class ServiceProviderResilienceTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.session = integration.ServiceProvider(
+            auth_type=integration.ServiceProvider.AuthMethods.API_KEY,
+            credentials={'API_KEY': 'key'},
+        ).request_header_creator()
+
+    def get_state(self):
+        return integration.get_breaker_states(['https://backend'])['https://backend']
+
+    @override_settings(CORE_PROVIDER_HTTP={'HOSTS': {'https://backend': {'BREAKER_FAILURES': 3}}})
+    def test_breaker_is_opened_by_failures_and_rejects_calls(self):
+        with requests_mock.Mocker() as mocker:
+            devices = mocker.get('https://backend/devices/', status_code=503)
+            with self.assertLogs('app_core.resilience', 'WARNING') as logs:
+                for _ in range(3):
+                    self.assertEqual(
+                        self.session.get('https://backend/devices/').status_code, 503
+                    )
+            self.assertIn('Circuit breaker of https://backend is open.', logs.output[0])
+            self.assertEqual(self.get_state()['state'], resilience.CircuitBreaker.OPEN)
+
+            with self.assertRaises(BackendUnavailable):
+                self.session.get('https://backend/devices/')
+            self.assertEqual(devices.call_count, 3)
+
+    def expire_open_state(self):
+        breaker = integration.get_breaker('https://backend')
+        cache.set(breaker.state_key, {
+            'state': resilience.CircuitBreaker.OPEN,
+            'opened_at': time.time() - breaker.reset_timeout,
+        })
+
+    def test_half_open_breaker_is_closed_by_successful_probe(self):
+        self.expire_open_state()
+        with requests_mock.Mocker() as mocker, self.assertLogs('app_core.resilience'):
+            mocker.get('https://backend/devices/', status_code=500)
+            self.session.get('https://backend/devices/')
+            self.assertEqual(self.get_state()['state'], resilience.CircuitBreaker.OPEN)
+
+            self.expire_open_state()
+
+            breaker = integration.get_breaker('https://backend')
+            self.assertEqual(breaker.before_call(), resilience.CircuitBreaker.HALF_OPEN)
+            # Only one probe is let through
+            with self.assertRaises(BackendUnavailable):
+                breaker.before_call()
+            breaker.release(resilience.CircuitBreaker.HALF_OPEN)
+
+            mocker.get('https://backend/devices/', json=[])
+            self.session.get('https://backend/devices/')
+            self.assertEqual(self.get_state(), {
+                'host': 'https://backend',
+                'state': resilience.CircuitBreaker.CLOSED,
+                'failures': 0,
+                'opened_at': None,
+            })
+
+    def test_connection_errors_are_counted_as_failures(self):
+        with requests_mock.Mocker() as mocker:
+            mocker.get('https://backend/devices/', exc=requests.ConnectionError)
+            for _ in range(2):
+                with self.assertRaises(requests.ConnectionError):
+                    self.session.get('https://backend/devices/')
+        self.assertEqual(self.get_state()['failures'], 2)
+        self.assertEqual(self.get_state()['state'], resilience.CircuitBreaker.CLOSED)
+
+    def test_calls_over_rate_limit_are_rejected(self):
+        with requests_mock.Mocker() as mocker:
+            devices = mocker.get('https://backend/devices/', json=[])
+            for _ in range(2):
+                self.session.get('https://backend/devices/')
+            with self.assertRaises(BackendRateLimited):
+                self.session.get('https://backend/devices/')
+            self.assertEqual(devices.call_count, 2)
+
+    def test_rate_limiter_waits_for_token(self):
+        limiter = resilience.RateLimiter('https://limited', rate=50, burst=1, wait=1)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.03)
+
+    @override_settings(CORE_PROVIDER_HTTP={'HOSTS': {'https://backend': {'BREAKER_FAILURES': 2}}})
+    def test_async_provider_uses_breaker(self):
+        provider = async_integration.AsyncServiceProvider(
+            host='https://backend',
+            auth_type=integration.ServiceProvider.AuthMethods.API_KEY,
+            credentials={'API_KEY': 'key'},
+            max_concurrency=1,
+            transport=httpx.MockTransport(lambda request: httpx.Response(502)),
+        )
+
+        async def run():
+            async with provider:
+                return await provider.request_many(
+                    [('GET', '/devices/')] * 3, return_exceptions=True
+                )
+
+        with self.assertLogs('app_core.resilience', 'WARNING'):
+            results = asyncio.run(run())
+        self.assertEqual(self.get_state()['state'], resilience.CircuitBreaker.OPEN)
+        self.assertIsInstance(results[-1], BackendUnavailable)
+
+    def test_async_provider_does_not_call_cache_in_event_loop(self):
+        threads = []
+
+        class Breaker(resilience.CircuitBreaker):
+            def before_call(self):
+                threads.append(threading.get_ident())
+                return super().before_call()
+
+            def after_call(self, state, failed):
+                threads.append(threading.get_ident())
+                super().after_call(state, failed)
+
+        class RateLimiter(resilience.RateLimiter):
+            def reserve(self):
+                threads.append(threading.get_ident())
+                return super().reserve()
+
+        get_breaker, get_rate_limiter = integration.get_breaker, integration.get_rate_limiter
+        integration.get_breaker = lambda host: Breaker(host)
+        integration.get_rate_limiter = lambda host: RateLimiter(host, rate=100)
+        self.addCleanup(setattr, integration, 'get_breaker', get_breaker)
+        self.addCleanup(setattr, integration, 'get_rate_limiter', get_rate_limiter)
+        provider = async_integration.AsyncServiceProvider(
+            host='https://backend',
+            auth_type=integration.ServiceProvider.AuthMethods.API_KEY,
+            credentials={'API_KEY': 'key'},
+            transport=httpx.MockTransport(lambda request: httpx.Response(200)),
+        )
+
+        async def run():
+            async with provider:
+                await provider.request_many([('GET', '/devices/')] * 2)
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(run())
+        self.assertEqual(len(threads), 6)
+        self.assertNotIn(loop_thread, threads)
+
+
+@override_settings(CORE_PROVIDER_HTTP={'HOSTS': {'https://backend': {'RESPONSE_CACHE_TTL': 5}}})
+class ServiceProviderResponseCacheTest(TestCase):
+    url = 'https://backend/devices/'
+
+    def setUp(self):
+        cache.clear()
+        integration.get_response_cache('https://backend').local_cache.clear()
+
+    def get_session(self, api_key='key'):
+        return integration.ServiceProvider(
+            auth_type=integration.ServiceProvider.AuthMethods.API_KEY,
+            credentials={'API_KEY': api_key},
+        ).request_header_creator()
+
+    def expire(self, response):
+        responses = integration.get_response_cache('https://backend')
+        key = responses.get_cache_key(response.request)
+        responses.local_cache.clear()
+        cache.set(key, dict(cache.get(key), fresh_until=0))
+
+    def test_fresh_response_is_shared_by_sessions(self):
+        with requests_mock.Mocker() as mocker:
+            devices = mocker.get(self.url, json=[{'id': 1}])
+            self.assertFalse(hasattr(self.get_session().get(self.url), 'from_cache'))
+
+            # Process cache is dropped, response is still available in shared cache
+            integration.get_response_cache('https://backend').local_cache.clear()
+            response = self.get_session().get(self.url)
+            self.assertTrue(response.from_cache)
+            self.assertEqual(response.json(), [{'id': 1}])
+            self.assertEqual(devices.call_count, 1)
+
+            self.get_session('another-key').get(self.url)
+            self.assertEqual(devices.call_count, 2)
+
+    def test_stale_response_is_revalidated(self):
+        session = self.get_session()
+        with requests_mock.Mocker() as mocker:
+            mocker.get(self.url, json=[{'id': 1}], headers={
+                'ETag': '"v1"', 'Last-Modified': 'Sun, 18 Oct 2026 10:00:00 GMT',
+            })
+            self.expire(session.get(self.url))
+
+            mocker.get(self.url, status_code=304)
+            response = session.get(self.url)
+            self.assertEqual(mocker.last_request.headers['If-None-Match'], '"v1"')
+            self.assertEqual(
+                mocker.last_request.headers['If-Modified-Since'],
+                'Sun, 18 Oct 2026 10:00:00 GMT',
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), [{'id': 1}])
+
+            # Revalidated response is fresh again
+            session.get(self.url)
+            self.assertEqual(mocker.call_count, 2)
+
+    def test_changed_response_replaces_stale_one(self):
+        session = self.get_session()
+        with requests_mock.Mocker() as mocker:
+            mocker.get(self.url, json=[{'id': 1}], headers={'ETag': '"v1"'})
+            self.expire(session.get(self.url))
+
+            mocker.get(self.url, json=[{'id': 2}], headers={'ETag': '"v2"'})
+            self.assertEqual(session.get(self.url).json(), [{'id': 2}])
+            self.assertEqual(session.get(self.url).json(), [{'id': 2}])
+            self.assertEqual(mocker.call_count, 2)
+
+    def test_response_is_invalidated_by_unsafe_request(self):
+        session = self.get_session()
+        with requests_mock.Mocker() as mocker:
+            devices = mocker.get(self.url, json=[])
+            mocker.post(self.url, status_code=201, json={'id': 1})
+            session.get(self.url)
+            session.post(self.url, json={})
+            session.get(self.url)
+            self.assertEqual(devices.call_count, 2)
+
+    def test_errors_and_no_store_responses_are_not_cached(self):
+        session = self.get_session()
+        with requests_mock.Mocker() as mocker:
+            devices = mocker.get(self.url, [
+                {'status_code': 500},
+                {'json': [], 'headers': {'Cache-Control': 'no-store'}},
+                {'json': []},
+            ])
+            for _ in range(3):
+                session.get(self.url)
+            self.assertEqual(devices.call_count, 3)
+
+
+class StateTransitionTest(ModelTablesMixin, TestCase):
+    table_models = (test_models.StateModel,)
+    States = test_models.StateModel.States
+
+    def setUp(self):
+        self.instance = test_models.StateModel.objects.create(
+            name='vm', state=self.States.UPDATING
+        )
+        self.transitions = []
+        post_transition.connect(self.record_transition, sender=test_models.StateModel)
+        self.addCleanup(
+            post_transition.disconnect, self.record_transition, sender=test_models.StateModel
+        )
+
+    def record_transition(self, instance, name, source, target, **kwargs):
+        self.transitions.append((instance.pk, name, source, target))
+
+    def get_state(self, instance=None):
+        return test_models.StateModel.objects.get(pk=(instance or self.instance).pk).state
+
+    def test_transition_is_applied_with_single_update(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(self.instance.transition_state('set_ok', action='resize'))
+        self.assertEqual(self.instance.state, self.States.OK)
+        instance = test_models.StateModel.objects.get(pk=self.instance.pk)
+        self.assertEqual((instance.state, instance.action), (self.States.OK, 'resize'))
+        self.assertEqual(
+            self.transitions,
+            [(self.instance.pk, 'set_ok', self.States.UPDATING, self.States.OK)],
+        )
+
+    def test_transition_is_not_applied_if_state_was_changed_concurrently(self):
+        test_models.StateModel.objects.filter(pk=self.instance.pk).update(
+            state=self.States.DELETION_SCHEDULED
+        )
+        self.assertFalse(self.instance.transition_state('set_ok'))
+        self.assertEqual(self.get_state(), self.States.DELETION_SCHEDULED)
+        self.assertEqual(self.transitions, [])
+
+        with self.assertRaisesRegex(tasks.StateChangeError, 'Deletion Scheduled'):
+            tasks.StateTransitionTask().state_transition(self.instance, 'set_ok')
+        self.assertEqual(self.get_state(), self.States.DELETION_SCHEDULED)
+
+    def test_failed_instance_is_erred_after_error_message_is_saved(self):
+        result = engines.LocalResult('task-1', 'Backend error', 'Traceback', states.FAILURE)
+        for task in (tasks.ErrorMessageTask(), tasks.ErrorStateTransitionTask()):
+            task.result = result
+            with self.assertLogs('app_core.tasks', 'ERROR'):
+                task.execute(self.instance)
+        instance = test_models.StateModel.objects.get(pk=self.instance.pk)
+        self.assertEqual(instance.state, self.States.ERRED)
+        self.assertEqual(instance.error_message, 'Backend error')
+        self.assertEqual(
+            self.transitions,
+            [(self.instance.pk, 'set_erred', self.States.UPDATING, self.States.ERRED)],
+        )
+
+    def test_transition_is_not_applied_from_disallowed_source(self):
+        self.assertFalse(self.instance.transition_state('recover'))
+        self.assertEqual(self.get_state(), self.States.UPDATING)
+
+        self.assertTrue(self.instance.transition_state('set_erred'))
+        self.assertTrue(self.instance.transition_state('recover'))
+        self.assertEqual(self.get_state(), self.States.OK)
+
+    def test_queryset_transition_changes_allowed_objects(self):
+        erred = test_models.StateModel.objects.create(state=self.States.ERRED)
+        queryset = test_models.StateModel.objects.all()
+        with self.assertNumQueries(1):
+            self.assertEqual(queryset.transition('recover'), 1)
+        self.assertEqual(self.get_state(erred), self.States.OK)
+        self.assertEqual(self.get_state(), self.States.UPDATING)
+
+        self.assertEqual(queryset.transition('schedule_deleting', action='delete'), 2)
+        self.assertEqual(
+            set(queryset.values_list('state', 'action')),
+            {(self.States.DELETION_SCHEDULED, 'delete')},
+        )
+        # Bulk transitions do not send signals
+        self.assertEqual(self.transitions, [])
+
+
+class ExecuteManyTest(ModelTablesMixin, TestCase):
+    table_models = (test_models.StateModel,)
+    States = test_models.StateModel.States
+
+    class RecordingDispatcher:
+        def __init__(self):
+            self.published = []
+
+        def publish(self, signature, **options):
+            self.published.append((signature, options))
+
+        def publish_many(self, signatures, **options):
+            for signature in signatures:
+                self.publish(signature, **options)
+
+    class BackendMethodMixin:
+        @classmethod
+        def get_task_signature(cls, instance, serialized_instance, **kwargs):
+            return tasks.BackendMethodTask().si(serialized_instance, 'pull')
+
+    def setUp(self):
+        self.dispatcher = self.RecordingDispatcher()
+        self.addCleanup(setattr, executors, 'dispatcher', executors.dispatcher)
+        executors.dispatcher = self.dispatcher
+
+        class DeleteExecutor(self.BackendMethodMixin, executors.DeleteExecutor):
+            pass
+
+        class UpdateExecutor(self.BackendMethodMixin, executors.UpdateExecutor):
+            pass
+
+        class RecoverExecutor(self.BackendMethodMixin, executors.BaseExecutor):
+            @classmethod
+            def pre_apply_many(cls, instances, **kwargs):
+                return cls.bulk_transition(instances, 'recover')
+
+        self.DeleteExecutor = DeleteExecutor
+        self.UpdateExecutor = UpdateExecutor
+        self.RecoverExecutor = RecoverExecutor
+        self.instances = [
+            test_models.StateModel.objects.create(name='vm-%s' % index, state=self.States.OK)
+            for index in range(5)
+        ]
+
+    def get_published_tasks(self):
+        return [task for chunk, _ in self.dispatcher.published for task in chunk.tasks]
+
+    def test_states_are_changed_with_single_update(self):
+        with self.assertNumQueries(1):
+            self.DeleteExecutor.execute_many(self.instances)
+        self.assertEqual(
+            set(test_models.StateModel.objects.values_list('state', flat=True)),
+            {self.States.DELETION_SCHEDULED},
+        )
+        self.assertEqual(
+            {instance.state for instance in self.instances}, {self.States.DELETION_SCHEDULED}
+        )
+
+    def test_signatures_are_published_in_chunks_with_own_links(self):
+        results = self.DeleteExecutor.execute_many(self.instances, chunk_size=2)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(
+            [len(chunk.tasks) for chunk, _ in self.dispatcher.published], [2, 2, 1]
+        )
+        self.assertEqual(
+            self.dispatcher.published[0][1],
+            {'countdown': 0, **routing.get_routing_options(routing.Priorities.BULK)},
+        )
+        for instance, task in zip(self.instances, self.get_published_tasks()):
+            serialized_instance = utils.serialize_instance(instance)
+            self.assertEqual(task.args[0], serialized_instance)
+            self.assertEqual(
+                [tuple(link['args']) for link in task.options['link']], [(serialized_instance,)]
+            )
+            self.assertEqual(
+                [tuple(link['args']) for link in task.options['link_error']],
+                [(serialized_instance,)],
+            )
+
+    def test_instances_without_applied_transition_are_skipped(self):
+        erred = self.instances[:2]
+        test_models.StateModel.objects.filter(pk__in=[i.pk for i in erred]).update(
+            state=self.States.ERRED
+        )
+        for instance in erred:
+            instance.refresh_from_db()
+        deleted = test_models.StateModel.objects.create(state=self.States.ERRED)
+        test_models.StateModel.objects.filter(pk=deleted.pk).delete()
+
+        self.RecoverExecutor.execute_many(self.instances + [deleted])
+        self.assertEqual(
+            [task.args[0] for task in self.get_published_tasks()],
+            [utils.serialize_instance(instance) for instance in erred],
+        )
+        self.assertEqual(self.instances[2].state, self.States.OK)
+
+        self.dispatcher.published = []
+        test_models.StateModel.objects.all().delete()
+        self.assertEqual(self.DeleteExecutor.execute_many(self.instances), [])
+        self.assertEqual(self.dispatcher.published, [])
+
+    def test_update_executor_requires_updated_fields(self):
+        with self.assertRaises(executors.ExecutorException):
+            self.UpdateExecutor.execute_many(self.instances)
+        self.assertEqual(self.dispatcher.published, [])
+        self.assertEqual(
+            set(test_models.StateModel.objects.values_list('state', flat=True)),
+            {self.States.OK},
+        )
+
+        self.UpdateExecutor.execute_many(self.instances, updated_fields=['name'])
+        self.assertEqual(len(self.get_published_tasks()), 5)
+        self.assertEqual(
+            set(test_models.StateModel.objects.values_list('state', flat=True)),
+            {self.States.UPDATE_SCHEDULED},
+        )
@@ -0,0 +1,48 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class ConstantQueriesMixin:
+    """ Assertions for test cases that check absence of N+1 queries """
+
+    def assertConstantQueries(self, func, grow, times=2):
+        """ Assert that func runs the same number of queries after each call of grow.
+
+            "grow" should add related objects that func renders, e.g. team members.
+            First call of func is not counted, so caches like authentication are warm.
+        """
+        func()
+        queries = []
+        for step in range(times + 1):
+            if step:
+                grow()
+            with CaptureQueriesContext(connection) as context:
+                func()
+            queries.append([query['sql'] for query in context.captured_queries])
+        counts = [len(step_queries) for step_queries in queries]
+        if len(set(counts)) > 1:
+            self.fail(
+                'Number of queries grows: %s. Queries of the last call:\n%s'
+                % (counts, '\n'.join(queries[-1]))
+            )
+
+
+class ModelTablesMixin:
+    """ Create tables of test-only models before test case and drop them after it """
+
+    table_models = ()
+
+    @classmethod
+    def setUpClass(cls):
+        # Schema is changed outside of transaction of test case, as SQLite requires
+        with connection.schema_editor() as editor:
+            for model in cls.table_models:
+                editor.create_model(model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connection.schema_editor() as editor:
+            for model in cls.table_models:
+                editor.delete_model(model)
@@ -6,9 +6,16 @@ from __future__ import (
 
 import functools
 import importlib
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from uuid import uuid4
 
 from django.apps import apps
+from django.core.cache import cache
 from django.db import transaction
+from django.urls import get_urlconf, reverse
 from django.utils.encoding import force_text
 
 
@@ -18,11 +25,140 @@ def serialize_instance(instance):
     return '{}:{}'.format(model_name, instance.pk)
 
 
+@functools.lru_cache(maxsize=None)
+def get_model(model_name):
+    """ Memoized model class lookup by "app_label.model_name" """
+    return apps.get_model(model_name)
+
+
+def get_instance_queryset(model):
+    """ Queryset used for deserialization.
+
+        Model may declare "deserialize_select_related" tuple of relations
+        that should be loaded together with instance.
+    """
+    queryset = model._default_manager.all()
+    select_related = getattr(model, 'deserialize_select_related', ())
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    return queryset
+
+
 def deserialize_instance(serialized_instance):
     """ Deserialize Django model instance """
     model_name, pk = serialized_instance.split(':')
-    model = apps.get_model(model_name)
-    return model._default_manager.get(pk=pk)
+    model = get_model(model_name)
+    return get_instance_queryset(model).get(pk=pk)
+
+
+def deserialize_instances(serialized_instances):
+    """ Deserialize many Django model instances using one query per model.
+
+        Instances are returned in the same order, deleted instances are skipped.
+    """
+    pks_by_model_name = defaultdict(list)
+    for serialized_instance in serialized_instances:
+        model_name, pk = serialized_instance.split(':')
+        pks_by_model_name[model_name].append(pk)
+
+    instances = {}
+    for model_name, pks in pks_by_model_name.items():
+        model = get_model(model_name)
+        for instance in get_instance_queryset(model).filter(pk__in=pks):
+            instances[serialize_instance(instance)] = instance
+    return [
+        instances[serialized_instance]
+        for serialized_instance in serialized_instances
+        if serialized_instance in instances
+    ]
+
+
+class ChainInstanceCache(threading.local):
+    """ Instances left by finished tasks for the next task of the same chain.
+
+        Instance is stored by id of task that has processed it and can be taken
+        only once by task which parent is that task. So the next task in a chain
+        that runs in the same worker does not load instance again.
+    """
+
+    max_size = 256
+
+    def __init__(self):
+        self.instances = OrderedDict()
+
+    def put(self, task_id, serialized_instance, instance):
+        self.instances[(task_id, serialized_instance)] = instance
+        while len(self.instances) > self.max_size:
+            self.instances.popitem(last=False)
+
+    def pop(self, task_id, serialized_instance):
+        return self.instances.pop((task_id, serialized_instance), None)
+
+
+chain_instances = ChainInstanceCache()
+
+
+URL_PLACEHOLDER = 'url-placeholder'
+
+
+@functools.lru_cache(maxsize=None)
+def _get_url_template(view_name, lookup_kwarg, urlconf):
+    return reverse(view_name, kwargs={lookup_kwarg: URL_PLACEHOLDER}, urlconf=urlconf)
+
+
+def get_url_template(view_name, lookup_kwarg, request=None):
+    """ Return URL of view with placeholder instead of lookup value.
+
+        URL is reversed only once, so links to many objects are built by
+        substitution of placeholder, see build_url.
+    """
+    url = _get_url_template(view_name, lookup_kwarg, get_urlconf())
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    return url
+
+
+def build_url(url_template, lookup_value):
+    return url_template.replace(URL_PLACEHOLDER, str(lookup_value))
+
+
+class QueryProperty(property):
+    """ Model property which value can also be computed by database """
+
+    def __init__(self, fget, expression):
+        super(QueryProperty, self).__init__(fget)
+        self.expression = expression
+        self.__doc__ = fget.__doc__
+
+    def get_expression(self):
+        # Callable allows to build expression lazily, e.g. when it refers other models
+        if hasattr(self.expression, 'resolve_expression'):
+            return self.expression
+        return self.expression()
+
+
+def query_property(expression):
+    """ Declare model property together with query expression equal to its value.
+
+        Such property can be used in filters and ordering, for example:
+
+            @query_property(lambda: Concat('first_name', Value(' '), 'last_name'))
+            def full_name(self):
+                return '%s %s' % (self.first_name, self.last_name)
+    """
+
+    def decorator(fget):
+        return QueryProperty(fget, expression)
+
+    return decorator
+
+
+def get_property_expression(model, name):
+    """ Return query expression of model property or None if it is not declared """
+    descriptor = getattr(model, name, None)
+    if isinstance(descriptor, QueryProperty):
+        return descriptor.get_expression()
+    return None
 
 
 def serialize_class(cls):
@@ -43,3 +179,64 @@ def ensure_atomic_transaction(func):
         with transaction.atomic():
             return func(self, *args, **kwargs)
     return wrapped
+
+
+@contextmanager
+def cache_lock(key, timeout=10, wait=0, interval=0.05):
+    """ Lock shared between workers via cache. Yields True if lock was acquired.
+
+        Waits up to "wait" seconds for lock, lock expires after "timeout" seconds.
+    """
+    token = uuid4().hex
+    deadline = time.monotonic() + wait
+    acquired = cache.add(key, token, timeout)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(interval)
+        acquired = cache.add(key, token, timeout)
+    try:
+        yield acquired
+    finally:
+        if acquired and cache.get(key) == token:
+            cache.delete(key)
+
+
+class LocalCache:
+    """ In-process cache with expiration and size limit, shared by threads of process.
+
+        It is used as the first tier in front of the shared Django cache for hot lookups.
+        Deletion is not propagated to other processes, so timeout should be short.
+    """
+
+    def __init__(self, timeout=5, max_size=1024):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self.values[key]
+                return default
+            self.values.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            self.values[key] = (value, time.monotonic() + timeout)
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
@@ -133,3 +133,24 @@ class CsrfExemptDRFLogin(CsrfExemptMixin, LoginView):
 class AuthViewSetMixin:
     authentication_classes = (account_authentication.ExpiringTokenAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
+
+
+class PrefetchPlanMixin:
+    """ Load relations of serialized objects in bulk.
+
+        Serializer declares "prefetch_plan": mapping of its field name to
+        lookups or Prefetch objects needed to render this field. Only plans
+        of fields that serializer renders are applied to queryset of view.
+    """
+
+    def get_prefetch_lookups(self, serializer_class):
+        plan = getattr(serializer_class, 'prefetch_plan', {})
+        fields = getattr(getattr(serializer_class, 'Meta', None), 'fields', ())
+        return [lookup for field in fields for lookup in plan.get(field, ())]
+
+    def get_queryset(self):
+        queryset = super(PrefetchPlanMixin, self).get_queryset()
+        lookups = self.get_prefetch_lookups(self.get_serializer_class())
+        if lookups:
+            queryset = queryset.prefetch_related(*lookups)
+        return queryset
@@ -0,0 +1,128 @@
+""" Compact binary serializer for Celery messages of executors.
+
+Message is encoded with msgpack. Strings repeated inside one message, like
+serialized instances, task names and argument names that appear both in
+arguments and in links, are stored once: first occurrence defines string,
+next occurrences reference it by index. Sets (e.g. "updated_fields") are preserved.
+
+Enable it with CELERY_TASK_SERIALIZER = "core-msgpack".
+"""
+import datetime
+import decimal
+import uuid
+
+from kombu.exceptions import SerializerNotInstalled
+from kombu.serialization import registry
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+SERIALIZER_NAME = 'core-msgpack'
+CONTENT_TYPE = 'application/x-core-msgpack'
+
+# Interning makes messages smaller at the cost of slower encoding in Python
+INTERN_STRINGS = True
+# Strings shorter than this are cheaper to store inline than to reference
+MIN_INTERNED_LENGTH = 4
+MAX_INTERNED_STRINGS = 256
+
+INTERNED = 1
+DEFINED = 6
+SET = 2
+DATETIME = 3
+DATE = 4
+DECIMAL = 5
+
+
+def _intern(obj, references):
+    if isinstance(obj, str):
+        reference = references.get(obj)
+        if reference is not None:
+            return reference
+        if len(obj) < MIN_INTERNED_LENGTH or len(references) >= MAX_INTERNED_STRINGS:
+            return obj
+        references[obj] = msgpack.ExtType(INTERNED, bytes((len(references),)))
+        return msgpack.ExtType(DEFINED, obj.encode('utf-8'))
+    if isinstance(obj, dict):
+        return {
+            _intern(key, references): _intern(value, references)
+            for key, value in obj.items()
+        }
+    if isinstance(obj, (list, tuple)):
+        return [_intern(item, references) for item in obj]
+    if isinstance(obj, (set, frozenset)):
+        return msgpack.ExtType(
+            SET, msgpack.packb([_intern(item, references) for item in obj], default=_default)
+        )
+    return obj
+
+
+def _default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return msgpack.ExtType(SET, msgpack.packb(list(obj), default=_default))
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(DATETIME, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(DATE, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(DECIMAL, str(obj).encode('utf-8'))
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, msgpack.ExtType):
+        return obj
+    raise TypeError('Cannot serialize object of type %s' % type(obj).__name__)
+
+
+def dumps(obj):
+    if INTERN_STRINGS:
+        obj = _intern(obj, {})
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def loads(data):
+    table = []
+
+    def ext_hook(code, data):
+        if code == INTERNED:
+            return table[data[0]]
+        if code == DEFINED:
+            string = data.decode('utf-8')
+            table.append(string)
+            return string
+        if code == SET:
+            return set(
+                msgpack.unpackb(data, ext_hook=ext_hook, strict_map_key=False, raw=False)
+            )
+        if code == DATETIME:
+            return datetime.datetime.fromisoformat(data.decode('utf-8'))
+        if code == DATE:
+            return datetime.date.fromisoformat(data.decode('utf-8'))
+        if code == DECIMAL:
+            return decimal.Decimal(data.decode('utf-8'))
+        return msgpack.ExtType(code, data)
+
+    return msgpack.unpackb(data, ext_hook=ext_hook, strict_map_key=False, raw=False)
+
+
+def register():
+    """ Register serializer in Kombu. Should be done by both producers and workers """
+    if msgpack is not None:
+        registry.register(
+            SERIALIZER_NAME, dumps, loads,
+            content_type=CONTENT_TYPE,
+            content_encoding='binary',
+        )
+        return
+
+    def not_available(*args, **kwargs):
+        raise SerializerNotInstalled(
+            'No decoder installed for %s. Install the msgpack library' % SERIALIZER_NAME
+        )
+
+    registry.register(SERIALIZER_NAME, None, not_available, CONTENT_TYPE)
+
+
+register()
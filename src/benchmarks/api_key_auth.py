@@ -0,0 +1,74 @@
+""" Compare throughput of API key authenticated requests with and without verified key cache.
+
+Creates test database, so it needs the same database settings as tests.
+Run from "src" directory: python -m benchmarks.api_key_auth [requests]
+"""
+import os
+import sys
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Core.settings')
+django.setup()
+
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test.utils import override_settings, setup_test_environment  # noqa: E402
+from rest_framework.reverse import reverse  # noqa: E402
+from rest_framework.test import APIClient, APIRequestFactory  # noqa: E402
+
+from app_account import authentication, models  # noqa: E402
+
+
+def create_key():
+    user = models.User.objects.create_user('benchmark', password='benchmark')
+    team = models.Team.objects.create(name='benchmark')
+    models.Membership.objects.create(user=user, team=team)
+    api_key, key = models.AccountAPIKey.objects.create_key(
+        name='benchmark', user=user, team=team
+    )
+    return key
+
+
+def measure(func, count):
+    func()  # warm up
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return time.perf_counter() - start
+
+
+def run(count=2000):
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        header = 'Api-Key %s' % create_key()
+        client = APIClient()
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=header)
+        url = reverse('team-list')
+
+        def get_list():
+            response = client.get(url, HTTP_AUTHORIZATION=header)
+            assert response.status_code == 200, response.status_code
+
+        def authenticate():
+            authentication.ApiKeyAuthentication().authenticate(request)
+
+        print('%d requests' % count)
+        print('%-10s %16s %16s' % ('cache', 'requests/s', 'authenticate us'))
+        for name, timeout in (('disabled', 0), ('enabled', 5 * 60)):
+            cache.clear()
+            authentication.local_cache.clear()
+            with override_settings(API_KEY_CACHE_TIMEOUT=timeout):
+                duration = measure(get_list, count)
+                auth_duration = measure(authenticate, count)
+            print('%-10s %16.1f %16.2f' % (
+                name, count / duration, auth_duration / count * 1e6,
+            ))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
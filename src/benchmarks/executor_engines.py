@@ -0,0 +1,58 @@
+""" Compare overhead of synchronous executor run with local engine and Celery eager apply.
+
+Run from "src" directory: python -m benchmarks.executor_engines [calls]
+"""
+import os
+import sys
+import timeit
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Core.settings')
+django.setup()
+
+from celery import Task, current_app  # noqa: E402
+
+from app_core import engines  # noqa: E402
+
+
+class AddTask(Task):
+    name = 'benchmarks.AddTask'
+
+    def run(self, x, y):
+        return x + y
+
+
+class CallbackTask(Task):
+    name = 'benchmarks.CallbackTask'
+
+    def run(self, *args):
+        pass
+
+
+def run_eager(signature, link):
+    """ Former synchronous branch of BaseExecutor.execute """
+    result = signature.apply()
+    if link is not None:
+        link.apply()
+    return result.get()
+
+
+def run(count=5000):
+    add = current_app.register_task(AddTask())
+    callback = current_app.register_task(CallbackTask())
+
+    print('%d calls' % count)
+    print('%-8s %14s' % ('engine', 'us/call'))
+    for name, execute in (
+        ('eager', run_eager),
+        ('local', lambda signature, link: engines.run(signature, link=link)),
+    ):
+        duration = timeit.timeit(
+            lambda: execute(add.si(1, 2), callback.si()), number=count
+        )
+        print('%-8s %14.2f' % (name, duration / count * 1e6))
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
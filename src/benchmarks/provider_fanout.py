@@ -0,0 +1,82 @@
+""" Compare fan-out of backend requests by synchronous and async providers.
+
+Backend is emulated by local HTTP server that answers after fixed delay.
+
+Run from "src" directory: python -m benchmarks.provider_fanout [requests] [delay_ms] [concurrency]
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Core.settings')
+django.setup()
+
+from app_core import async_integration, integration  # noqa: E402
+
+
+def make_handler(delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(delay)
+            body = json.dumps({'path': self.path}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def run(count=200, delay_ms=20, concurrency=50):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(delay_ms / 1000))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = 'http://127.0.0.1:%s' % server.server_port
+    auth = integration.ServiceProvider.AuthMethods.API_KEY
+    credentials = {'API_KEY': 'key'}
+    urls = ['%s/devices/%s/' % (host, index) for index in range(count)]
+
+    def run_sync():
+        session = integration.ServiceProvider(
+            host=host, auth_type=auth, credentials=credentials
+        ).request_header_creator()
+        for url in urls:
+            session.get(url).json()
+
+    def run_async():
+        async def fetch():
+            async with async_integration.AsyncServiceProvider(
+                    host=host, auth_type=auth, credentials=credentials,
+                    max_concurrency=concurrency,
+            ) as provider:
+                responses = await provider.request_many([('GET', url) for url in urls])
+                return [response.json() for response in responses]
+
+        asyncio.run(fetch())
+
+    print('%d requests, %d ms backend latency, concurrency %d' % (count, delay_ms, concurrency))
+    print('%-8s %10s %12s' % ('client', 'seconds', 'requests/s'))
+    for name, execute in (('sync', run_sync), ('async', run_async)):
+        start = time.perf_counter()
+        execute()
+        duration = time.perf_counter() - start
+        print('%-8s %10.2f %12.1f' % (name, duration, count / duration))
+
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,74 @@
+""" Compare size and encode/decode speed of executor messages in JSON and core-msgpack.
+
+Run from "src" directory: python -m benchmarks.wire_format [messages]
+"""
+import sys
+import timeit
+
+from celery import signature
+from kombu.utils import json
+
+from app_core import wire
+
+
+def make_message(pk, updated_fields):
+    """ Celery protocol 2 body of UpdateExecutor task with success and failure links """
+    serialized_instance = 'app_network.networkdevice:%s' % pk
+    kwargs = {
+        'backend_method': 'update_device',
+        'state_transition': 'begin_updating',
+        'updated_fields': updated_fields,
+        'action_details': {
+            'message': 'Update device configuration',
+            'executor': 'app_network.executors:DeviceUpdateExecutor',
+        },
+    }
+    link = signature(
+        'app_core.StateTransitionTask',
+        args=(serialized_instance,),
+        kwargs={'state_transition': 'set_ok', 'action': '', 'action_details': {}},
+        immutable=True,
+    )
+    link_error = signature('app_core.ErrorStateTransitionTask', args=(serialized_instance,))
+    embed = {'callbacks': [link], 'errbacks': [link_error], 'chain': None, 'chord': None}
+    return [serialized_instance, 'update_device'], kwargs, embed
+
+
+def run(count=5000):
+    fields = {'name', 'description', 'backend_id', 'runtime_state'}
+    messages = [make_message(pk, fields) for pk in range(count)]
+    # JSON cannot encode sets, so producers have to send lists
+    json_messages = [
+        (args, dict(kwargs, updated_fields=sorted(fields)), embed)
+        for args, kwargs, embed in messages
+    ]
+
+    def encode_without_interning(message):
+        wire.INTERN_STRINGS = False
+        try:
+            return wire.dumps(message)
+        finally:
+            wire.INTERN_STRINGS = True
+
+    results = []
+    for name, encode, decode, payloads in (
+        ('json', json.dumps, json.loads, json_messages),
+        (wire.SERIALIZER_NAME, wire.dumps, wire.loads, messages),
+        ('(no interning)', encode_without_interning, wire.loads, messages),
+    ):
+        encoded = [encode(message) for message in payloads]
+        size = sum(len(body) for body in encoded)
+        encode_time = timeit.timeit(lambda: [encode(m) for m in payloads], number=3) / 3
+        decode_time = timeit.timeit(lambda: [decode(b) for b in encoded], number=3) / 3
+        results.append((name, size, encode_time, decode_time))
+
+    print('%d messages' % count)
+    print('%-14s %12s %12s %14s %14s' % ('format', 'total bytes', 'bytes/msg', 'encode us/msg', 'decode us/msg'))
+    for name, size, encode_time, decode_time in results:
+        print('%-14s %12d %12.1f %14.2f %14.2f' % (
+            name, size, size / count, encode_time / count * 1e6, decode_time / count * 1e6,
+        ))
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])